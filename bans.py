@@ -0,0 +1,196 @@
+import ipaddress, json, os, queue, re, threading, time
+
+COMPACT_MIN_RECORDS = 1000  # Log lines before compaction is considered at all
+COMPACT_RATIO = 2  # Compact once the log holds this many lines per live ban
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_duration(text):
+    """ '90', '30m', '12h', '7d' or '2w' -> seconds """
+    match = re.fullmatch(r'(\d+)([smhdw]?)', text)
+    if not match:
+        raise ValueError(f"Invalid duration '{text}'")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+def normalize(target):
+    """ An address or CIDR range as an ip_network, IPv4-mapped IPv6 addresses count as IPv4 """
+    network = ipaddress.ip_network(target.strip(), strict=False)
+    if network.version == 6 and network.prefixlen >= 96 and network.network_address.ipv4_mapped is not None:
+        network = ipaddress.ip_network(f"{network.network_address.ipv4_mapped}/{network.prefixlen - 96}")
+    return network
+
+class PrefixTrie:
+    """
+    Binary trie over address bits for CIDR ranges.
+    A lookup walks at most 32 (IPv4) or 128 (IPv6) nodes whatever the number of ranges stored.
+    Nodes are [child 0, child 1, expiry], where expiry is None for no range ending at the node,
+    0 for a permanent one, or a Unix time.
+    """
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+
+    def insert(self, network, expiry):
+        node, value = self.root, int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (value >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = expiry
+
+    def remove(self, network):
+        node, value = self.root, int(network.network_address)
+        for i in range(network.prefixlen):
+            node = node[(value >> (self.bits - 1 - i)) & 1]
+            if node is None:
+                return
+        node[2] = None  # Empty branches are dropped when the log is compacted and the bans reloaded
+
+    def match(self, address, now):
+        """ True if a range that hasn't expired covers `address` """
+        node, value = self.root, int(address)
+        for i in range(self.bits + 1):
+            expiry = node[2]
+            if expiry is not None and (expiry == 0 or expiry > now):
+                return True
+            if i == self.bits:
+                return False
+            node = node[(value >> (self.bits - 1 - i)) & 1]
+            if node is None:
+                return False
+
+class BanList:
+    """
+    Indexed IP bans: a dict for single addresses and a prefix trie per IP version for ranges.
+    Every change is appended to a log file by a background thread, so banning never waits on
+    the disk, and the log is rewritten with only the live bans once it has grown enough.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.addresses = {}  # Normalized address -> expiry (0 for permanent)
+        self.ranges = {}  # Normalized CIDR string -> expiry, the tries are built from it
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.lock = threading.Lock()
+        self.log_records = 0
+        self.writes = None  # Queue of log lines for the writer thread, once opened
+
+    def __len__(self):
+        return len(self.addresses) + len(self.ranges)
+
+    def open(self, legacy_file=None):
+        """ Load the log (or import a legacy JSON list of IPs on first start) and start the writer """
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._apply(record['op'], normalize(record['target']), record.get('expires', 0))
+                    except (ValueError, KeyError):
+                        continue  # A line cut short by a crash
+                    self.log_records += 1
+        elif legacy_file and os.path.exists(legacy_file):
+            with open(legacy_file) as f:
+                for address in json.load(f):
+                    try:
+                        self._apply('ban', normalize(address), 0)
+                    except ValueError:
+                        pass
+        self.writes = queue.Queue()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+        if not os.path.exists(self.path) and len(self):
+            self.writes.put(None)  # Imported from the legacy file, write it out as a log
+
+    def is_banned(self, address):
+        """ Check an address in O(1) for exact bans plus one trie walk for ranges """
+        try:
+            address = normalize(address).network_address
+        except ValueError:
+            return False
+        now = time.time()
+        expiry = self.addresses.get(str(address))
+        if expiry is not None and (expiry == 0 or expiry > now):
+            return True
+        return self.tries[address.version].match(address, now)
+
+    def ban(self, target, duration=None):
+        """ Ban an address or CIDR range, for `duration` seconds or for good. Returns the normalized target """
+        network = normalize(target)
+        expires = time.time() + duration if duration else 0
+        with self.lock:
+            self._apply('ban', network, expires)
+        self._log({'op': 'ban', 'target': str(network), 'expires': expires})
+        return self._key(network)
+
+    def unban(self, target):
+        """ Lift a ban, returns False if there was none on exactly that address or range """
+        network = normalize(target)
+        with self.lock:
+            if self._key(network) not in (self.addresses if network.num_addresses == 1 else self.ranges):
+                return False
+            self._apply('unban', network)
+        self._log({'op': 'unban', 'target': str(network)})
+        return True
+
+    def entries(self):
+        """ (target, expiry) for every ban that hasn't expired """
+        now = time.time()
+        with self.lock:
+            bans = list(self.addresses.items()) + list(self.ranges.items())
+        return [(target, expiry) for target, expiry in bans if expiry == 0 or expiry > now]
+
+    def _key(self, network):
+        return str(network.network_address) if network.num_addresses == 1 else str(network)
+
+    def _apply(self, op, network, expires=0):
+        key = self._key(network)
+        if network.num_addresses == 1:
+            if op == 'ban':
+                self.addresses[key] = expires
+            else:
+                self.addresses.pop(key, None)
+        elif op == 'ban':
+            self.ranges[key] = expires
+            self.tries[network.version].insert(network, expires)
+        elif self.ranges.pop(key, None) is not None:
+            self.tries[network.version].remove(network)
+
+    def _log(self, record):
+        if self.writes is not None:
+            self.writes.put(json.dumps(record))
+
+    def _write_loop(self):
+        """ Append queued records in batches, compacting the log when it is mostly dead lines """
+        while True:
+            lines = [self.writes.get()]
+            while not self.writes.empty():
+                lines.append(self.writes.get())
+            if None in lines or (self.log_records >= COMPACT_MIN_RECORDS and self.log_records >= COMPACT_RATIO * len(self)):
+                self._compact()  # Covers the queued records too, they are already applied
+                continue
+            with open(self.path, 'a') as f:
+                f.write(''.join(line + '\n' for line in lines))
+                f.flush()
+                os.fsync(f.fileno())
+            self.log_records += len(lines)
+
+    def _compact(self):
+        """ Rewrite the log with one line per live ban, swapped in atomically, and rebuild the tries """
+        live = self.entries()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for target, expiry in live:
+                f.write(json.dumps({'op': 'ban', 'target': target, 'expires': expiry}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        with self.lock:
+            # Drop expired entries and the empty branches unbans left behind
+            tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+            now = time.time()
+            self.addresses = {target: expiry for target, expiry in self.addresses.items() if expiry == 0 or expiry > now}
+            self.ranges = {target: expiry for target, expiry in self.ranges.items() if expiry == 0 or expiry > now}
+            for target, expiry in self.ranges.items():
+                network = ipaddress.ip_network(target)
+                tries[network.version].insert(network, expiry)
+            self.tries = tries
+        self.log_records = len(live)
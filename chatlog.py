@@ -0,0 +1,42 @@
+import os, queue, threading, time
+
+FLUSH_INTERVAL = 1.0  # Seconds the writer collects lines before writing them out together
+
+class ChatLog:
+    """
+    Chat transcript on disk, written by a background thread.
+    add() only queues the line, the writer appends whatever piled up once per FLUSH_INTERVAL
+    and rotates the file to path.1, path.2... once it grows past max_bytes.
+    """
+    def __init__(self, path, max_bytes=1 << 20, backups=5):
+        self.path, self.max_bytes, self.backups = path, max_bytes, backups
+        self.lines = queue.Queue()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def add(self, seq, line):
+        self.lines.put(f"{time.strftime('%Y-%m-%d %H:%M:%S')} #{seq} {line}\n")
+
+    def write_loop(self):
+        while True:
+            batch = [self.lines.get()]
+            time.sleep(FLUSH_INTERVAL)
+            while not self.lines.empty():
+                batch.append(self.lines.get())
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(batch))
+                    size = f.tell()
+                if size > self.max_bytes:
+                    self.rotate()
+            except OSError as e:
+                print(f"Chat log: {e}")
+
+    def rotate(self):
+        """ chat.log -> chat.log.1 -> chat.log.2 ..., the oldest backup is dropped """
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
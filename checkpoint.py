@@ -0,0 +1,93 @@
+import mmap, os, struct, threading, zlib
+
+CHECKPOINT_MAGIC = b'ARCP'
+CHECKPOINT_VERSION = 1
+HEADER = struct.Struct('!4sHIdQIH')  # magic, version, crc32 of everything after the header, saved at, chat_seq, sessions, chat lines
+SESSION_RECORD = struct.Struct('!QiiIdB')  # token, x, y, color (0xRRGGBB), left at (0 if online), name length (name bytes follow)
+CHAT_LINE_HEADER = struct.Struct('!H')  # line length (utf-8 bytes follow)
+
+def write_checkpoint(path, saved_at, chat_seq, sessions, chat):
+    """
+    Write a checkpoint through a memory-mapped temporary file and swap it in atomically.
+    - sessions: (token, username, x, y, color, left_at) for every player that can resume
+    - chat: the recent chat lines, the last of which is number chat_seq
+    """
+    sessions = [(token, username.encode('utf-8'), x, y, color, left_at) for token, username, x, y, color, left_at in sessions]
+    chat = [line.encode('utf-8') for line in chat]
+    size = (HEADER.size + sum(SESSION_RECORD.size + len(name) for _, name, *_ in sessions)
+            + sum(CHAT_LINE_HEADER.size + len(line) for line in chat))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w+b') as f:
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as view:
+            offset = HEADER.size
+            for token, name, x, y, (r, g, b), left_at in sessions:
+                SESSION_RECORD.pack_into(view, offset, token, x, y, (r << 16) | (g << 8) | b, left_at, len(name))
+                offset += SESSION_RECORD.size
+                view[offset:offset + len(name)] = name
+                offset += len(name)
+            for line in chat:
+                CHAT_LINE_HEADER.pack_into(view, offset, len(line))
+                offset += CHAT_LINE_HEADER.size
+                view[offset:offset + len(line)] = line
+                offset += len(line)
+            crc = zlib.crc32(view[HEADER.size:])
+            HEADER.pack_into(view, 0, CHECKPOINT_MAGIC, CHECKPOINT_VERSION, crc, saved_at, chat_seq, len(sessions), len(chat))
+            view.flush()
+    os.replace(tmp_path, path)
+
+def read_checkpoint(path):
+    """ Load a checkpoint as a dict with the fields write_checkpoint takes, None if there is none or it is damaged """
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            magic, version, crc, saved_at, chat_seq, n_sessions, n_chat = HEADER.unpack_from(view)
+            if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION or zlib.crc32(view[HEADER.size:]) != crc:
+                return None
+            offset, sessions, chat = HEADER.size, [], []
+            for _ in range(n_sessions):
+                token, x, y, color, left_at, name_length = SESSION_RECORD.unpack_from(view, offset)
+                offset += SESSION_RECORD.size
+                username = str(view[offset:offset + name_length], 'utf-8')
+                offset += name_length
+                sessions.append((token, username, x, y, (color >> 16, (color >> 8) & 0xFF, color & 0xFF), left_at))
+            for _ in range(n_chat):
+                (length,) = CHAT_LINE_HEADER.unpack_from(view, offset)
+                offset += CHAT_LINE_HEADER.size
+                chat.append(str(view[offset:offset + length], 'utf-8'))
+                offset += length
+    except (OSError, ValueError, struct.error):
+        return None  # Missing, empty (mmap refuses those) or cut short
+    return {'saved_at': saved_at, 'chat_seq': chat_seq, 'sessions': sessions, 'chat': chat}
+
+class Checkpointer:
+    """
+    Writes checkpoints on a background thread.
+    submit() only hands over a state captured by the caller, so the tick never waits on the disk.
+    If the writer is still busy, a newer state replaces the one waiting and the older one is never written.
+    """
+    def __init__(self, path, build):
+        self.path, self.build = path, build  # build(state) -> write_checkpoint arguments after the path
+        self.pending = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.saved = 0  # Checkpoints written since the start
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def submit(self, state):
+        with self.lock:
+            self.pending = state
+        self.wakeup.set()
+
+    def write_loop(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                state, self.pending = self.pending, None
+            if state is None:
+                continue
+            try:
+                write_checkpoint(self.path, *self.build(state))
+                self.saved += 1
+            except OSError as e:
+                print(f"Checkpoint: {e}")
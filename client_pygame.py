@@ -1,4 +1,10 @@
-import pygame, sys, socket, threading, json, time, os
+import pygame, sys, socket, struct, threading, time, os, argparse, heapq, select, zlib
+from collections import OrderedDict, deque
+from protocol import PROTOCOL_VERSION, FEATURES, CHAT_HISTORY_SIZE, MOVE_STEP, MAX_INPUT_DURATION, FrameDecoder, encode_json, decode_json
+from protocol import MSG_INPUT_ACK, MSG_UDP_HELLO, HORIZONTAL_CODES, VERTICAL_CODES, DIRECTION_STEP, UDP_HEADER, UDP_HELLO, split_frames
+from protocol import SNAPSHOT_HEADER
+from protocol import is_binary, encode_input, encode_ack, decode_snapshot, decode_input_ack, Inflater
+from protocol import RENDER_TEXT_OPS, color_spans, span_colors
 
 pygame.init()
 SCREEN_WIDTH, SCREEN_HEIGHT = 800, 600
@@ -7,90 +13,454 @@ DEFAULT_FONT_NAME = 'Courier'
 DEFAULT_FONT_SIZE = 24
 FONT = pygame.font.SysFont(DEFAULT_FONT_NAME, DEFAULT_FONT_SIZE)  # Ensure FONT is defined
 FONT_CACHE = {}  # Cache to store loaded fonts
+GLYPH_ATLAS_SIZE = 4096  # Pre-rendered single characters kept for render_text elements and '@'
+TEXT_CACHE_SIZE = 512  # Pre-rendered strings (names, chat lines, bubbles) kept between frames
 FONT_SPACING = 2  # Default spacing between characters
 CHAT_HEIGHT, SERVER_PORT = 150, 55555
 MAX_CHAT_MESSAGES = 10  # Increased to show more chat messages
 MSG_CHAR_LIMIT = 60     # Limit input message to 60 characters
+DIRTY_RECT_LIMIT = 64   # Past this many changed regions a frame is redrawn and flipped whole
+INTERPOLATION_TICKS = 3  # Remote players are drawn this many server ticks in the past, between two snapshots
+POSITION_HISTORY = 16    # Snapshot positions kept per remote player for interpolation
+UDP_PROBE_INTERVAL = 0.25  # Seconds between hello probes while setting up the UDP channel
+UDP_PROBE_TIMEOUT = 2      # Give up on UDP and stay on TCP if nothing came back by then
+UDP_KEEPALIVE = 5          # Seconds between hellos once the channel is up, they keep NAT mappings open
+UDP_RESEND_LIMIT = 32      # Unacknowledged input commands repeated in every input datagram
+RECEIVE_DRAIN_LIMIT = 1 << 20  # Bytes read in one wakeup of the receive thread before handling them
+
+class WorldView:
+    """ The world as published by the receive thread for one or more frames, never changed once published """
+    __slots__ = ('players', 'history', 'chat', 'texts')
+
+    def __init__(self, players=None, history=None, chat=(), texts=()):
+        self.players = players or {}  # Username -> {'x', 'y', 'color'} as of the newest snapshot
+        self.history = history or {}  # Username -> tuple of (received time, x, y) for interpolation
+        self.chat = chat
+        self.texts = texts  # (id, element) pairs of the render_text layer, in drawing order
 
 class Client:
-    def __init__(self, username, server_host):
+    def __init__(self, username, server_host, chat_seq=None, session=None):
         self.username = username
         self.server_host = server_host
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((server_host, SERVER_PORT))
-        self.sock.sendall(self.username.encode('utf-8'))
+        # Open with a framed hello, the server answers with a welcome carrying our final username
+        # chat_seq is the last chat line seen before a reconnect, the server sends what we missed since,
+        # and session the token from the last welcome, which puts us back where we were
+        hello = {'hello': self.username, 'version': PROTOCOL_VERSION, 'features': list(FEATURES)}
+        if chat_seq is not None:
+            hello['chat_seq'] = chat_seq
+        if session is not None:
+            hello['session'] = session
+        self.session = session
+        self.sock.sendall(encode_json(hello))
+        self.decoder = FrameDecoder()
+        self.inflater = Inflater()  # Unwraps compressed frames, if the server agrees to compress
+        self.send_lock = threading.Lock()  # The listener thread sends acks while the main loop sends input
         self.running = True
+        # Players, chat and render_text elements belong to the receive threads (TCP and UDP), which
+        # take turns on receive_lock. self.lock only guards the input and prediction state shared with the main loop.
         self.chat_messages, self.players, self.lock = [], {}, threading.Lock()
+        self.receive_lock = threading.Lock()
+        self.front = WorldView()  # Replaced as a whole after every change, the renderer reads it once per frame
+        self.snapshot_seq = 0  # Last snapshot applied to self.players
+        self.binary = False  # Set once the server agrees to the binary codec
+        self.player_names = {}  # Player id -> username, filled from binary snapshots
+        self.chat_seq = chat_seq or 0  # Number of the newest line in self.chat_messages
+        self.chat_stream = False  # Set once the server agrees to push chat lines as they are said
+        self.predict = False  # Set once the server agrees to acknowledge our inputs
+        self.tick_interval = 1 / 30  # Seconds between server ticks, from the welcome
+        self.input_seq = 0  # Seq of the last input command sent
+        self.input_state = ('', '')  # Keys held in the command being sampled
+        self.input_frames = 0  # Frames sampled into that command so far
+        self.input_commands = []  # (horizontal, vertical, frames) finished but not sent yet
+        self.last_input_send = 0
+        self.pending_inputs = deque()  # (seq, dx, dy) sent but not yet acknowledged by the server
+        self.pending_dx = self.pending_dy = 0  # Sum of the pending inputs' movement
+        self.server_position = None  # Our position after the last acknowledged input
+        self.position_history = {}  # Username -> deque of (received time, x, y)
+        self.input_ack_seq = 0  # Newest input acknowledgement applied, older ones arriving late are ignored
+        self.udp_sock = None  # Connected datagram socket once the server offered UDP
+        self.udp_header = b''  # Session token every datagram we send starts with
+        self.udp_active = False  # Input and state travel over UDP, set once the server answered a probe
+        self.unacked_inputs = deque(maxlen=UDP_RESEND_LIMIT)  # (seq, frame) repeated until acknowledged, UDP only
         self.last_message_sender = None  # Track the last message sender
         self.last_message_timestamp = 0  # Track when the last message was received
         self.full_message_display = False  # To toggle full message display
         self.current_popup = None  # To store current popup message
-        self.render_text_elements = []  # List to store renderable text elements
+        self.text_layer = TextLayer()  # render_text elements from the server
 
     def listen_for_messages(self):
         while self.running:
             try:
-                message = self.sock.recv(4096).decode('utf-8')  # Increased buffer size
-                if message:
-                    with self.lock:
-                        data = json.loads(message)
-                        if 'command_result' in data:
-                            self.current_popup = data['command_result']  # Set popup message
-                            self.popup_start_time = time.time()
-                        elif 'render_text' in data:
-                            # Handle render_text instructions
-                            self.handle_render_text(data['render_text'])
-                        else:
-                            self.players = data['players']
-                            self.chat_messages = data['chat']
+                # Read everything the socket already holds into the decoder's buffer, then handle it in one go
+                received = total = self.decoder.recv_into(self.sock)
+                while received and total < RECEIVE_DRAIN_LIMIT and select.select([self.sock], [], [], 0)[0]:
+                    received = self.decoder.recv_into(self.sock)
+                    total += received
+                self.handle_frames(self.decoder.frames())
+                if received == 0:
+                    raise ConnectionResetError("Server closed the connection")
             except:
                 self.running = False
                 self.sock.close()
 
+    def handle_frames(self, payloads):
+        """
+        Handle the frames of one wakeup (TCP) or one datagram, then acknowledge the newest snapshot once.
+        Other messages are handled in order, but of a burst of snapshots and input acks only the
+        newest one is decoded and applied: a delta carries every change since the snapshot we
+        acknowledged, so the ones in between add nothing. The result is published to the renderer.
+        """
+        with self.receive_lock:
+            acked_seq, snapshots = self.snapshot_seq, 0
+            newest_state = input_ack = None  # (seq, payload or message)
+            changed = False
+            for payload in self.inflater.frames(payloads):
+                if is_binary(payload) and payload[0] == MSG_INPUT_ACK:
+                    ack = decode_input_ack(payload)
+                    input_ack = max(input_ack or ack, ack)
+                elif is_binary(payload) and payload[0] == MSG_UDP_HELLO:
+                    pass  # Probe answer, receiving it was the point
+                elif is_binary(payload):
+                    seq = SNAPSHOT_HEADER.unpack_from(payload)[2]
+                    if newest_state is None or seq > newest_state[0]:
+                        newest_state = (seq, payload)
+                    snapshots += 1
+                else:
+                    message = decode_json(payload)
+                    if 'snapshot' in message:
+                        if newest_state is None or message['snapshot']['seq'] > newest_state[0]:
+                            newest_state = (message['snapshot']['seq'], message)
+                    elif 'players' in message:
+                        newest_state = (0, message)  # Full state without a seq, the last one wins
+                    elif 'input_ack' in message:
+                        ack = (message['input_ack']['seq'], message['input_ack']['x'], message['input_ack']['y'])
+                        input_ack = max(input_ack or ack, ack)
+                    else:
+                        changed = self.handle_message(message) or changed
+            if input_ack:
+                with self.lock:
+                    self.reconcile(*input_ack)
+            if newest_state:
+                state = newest_state[1]
+                if isinstance(state, dict):
+                    self.handle_message(state)
+                else:
+                    self.apply_binary_snapshot(decode_snapshot(state))
+                changed = True
+            if changed:
+                self.publish()
+        # A repeated datagram means our ack got lost, so it goes out again even if nothing changed
+        if self.snapshot_seq != acked_seq or (snapshots and self.udp_active):
+            if self.binary:
+                self.send_hot(encode_ack(self.snapshot_seq))
+            else:
+                self.send({'ack': self.snapshot_seq})
+
+    def listen_for_datagrams(self, port, token):
+        """
+        Set up and run the UDP channel for input and state.
+        Hello probes go out until the server echoes one, only then is the server told (over TCP)
+        to send state this way. If no answer comes back, answers stop coming while the channel
+        is up or a datagram can't be decoded, everything stays on or goes back to TCP.
+        """
+        try:
+            self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_sock.connect((self.server_host, port))
+            self.udp_sock.settimeout(UDP_PROBE_INTERVAL)
+            self.udp_header = UDP_HEADER.pack(token)
+            last_hello, last_heard = 0, time.time()
+            while self.running:
+                now = time.time()
+                if now - last_heard > (3 * UDP_KEEPALIVE if self.udp_active else UDP_PROBE_TIMEOUT):
+                    break
+                if now - last_hello >= (UDP_KEEPALIVE if self.udp_active else UDP_PROBE_INTERVAL):
+                    self.udp_sock.send(self.udp_header + UDP_HELLO)
+                    last_hello = now
+                try:
+                    data = self.udp_sock.recv(65536)
+                except socket.timeout:
+                    continue
+                last_heard = time.time()
+                if not self.udp_active:
+                    self.udp_active = True
+                    self.send({'udp': True})
+                self.handle_frames(split_frames(data))
+        except (OSError, ValueError, struct.error, zlib.error):
+            pass  # Unreachable, refused or sent garbage, TCP carries on regardless
+        finally:
+            if self.udp_active:
+                self.udp_active = False  # Inputs go back to TCP too
+                if self.running:
+                    self.send({'udp': False})
+            if self.udp_sock is not None:
+                self.udp_sock.close()
+
+    def publish(self):
+        """ Swap in a fresh WorldView, copying out everything the receive thread goes on changing (call with self.receive_lock held) """
+        self.text_layer.expire(time.time())
+        self.front = WorldView(
+            {username: dict(player) for username, player in self.players.items()},
+            {username: tuple(history) for username, history in self.position_history.items()},
+            tuple(self.chat_messages), tuple(self.text_layer.elements.items())
+        )
+
+    def handle_message(self, data):
+        """ Handle one JSON message, returns True if it changed what the renderer shows """
+        if 'welcome' in data:
+            self.username = data['welcome']['username']  # The server may have added a suffix
+            self.binary = 'binary' in data['welcome'].get('features', ())
+            self.predict = 'predict' in data['welcome'].get('features', ())
+            self.chat_stream = 'chat_stream' in data['welcome'].get('features', ())
+            if data['welcome'].get('chat_seq', self.chat_seq) < self.chat_seq:
+                self.chat_seq = 0  # The server restarted and numbers its chat from scratch
+            self.tick_interval = 1 / data['welcome'].get('tick_rate', 30)
+            self.session = data['welcome'].get('session')
+            if 'udp' in data['welcome']:
+                udp = data['welcome']['udp']
+                threading.Thread(target=self.listen_for_datagrams, args=(udp['port'], udp['token']), daemon=True).start()
+            return False
+        elif 'chat_line' in data:
+            self.add_chat_lines([data['chat_line']['text']], data['chat_line']['seq'])
+        elif 'command_result' in data:
+            self.current_popup = data['command_result']  # Set popup message
+            self.popup_start_time = time.time()
+            return False
+        elif 'render_text' in data:
+            # Handle render_text instructions
+            self.handle_render_text(data['render_text'])
+        elif 'snapshot' in data:
+            self.apply_snapshot(data['snapshot'])
+        else:
+            self.players = data['players']
+            self.chat_messages = data['chat']
+            for username in list(self.position_history):
+                if username not in self.players:
+                    del self.position_history[username]
+            self.record_positions(self.players)
+        return True
+
+    def apply_snapshot(self, snapshot):
+        """
+        Patch self.players and self.chat_messages in place from a keyframe or a delta.
+        A delta holds every change since a snapshot we acknowledged, so it is safe to apply
+        on top of anything received after that one.
+        """
+        if snapshot['seq'] <= self.snapshot_seq:
+            return  # Overtaken by a newer one, datagrams and TCP frames can arrive in any order
+        if snapshot.get('keyframe'):
+            self.players.clear()
+            self.position_history.clear()
+            if not self.chat_stream:
+                self.chat_messages = []
+                self.chat_seq = snapshot['chat_seq'] - len(snapshot['chat'])
+        elif snapshot['base'] > self.snapshot_seq:
+            self.send({'resync': True})  # Delta against a snapshot we never saw, ask for a keyframe
+            return
+
+        for username in snapshot.get('removed', ()):
+            self.players.pop(username, None)
+            self.position_history.pop(username, None)
+        for username, fields in snapshot['players'].items():
+            self.players.setdefault(username, {}).update(fields)
+        self.record_positions(snapshot['players'])
+
+        if not self.chat_stream:
+            self.add_chat_lines(snapshot['chat'], snapshot['chat_seq'])
+        self.snapshot_seq = snapshot['seq']
+
+    def add_chat_lines(self, lines, chat_seq):
+        """ Append the lines we haven't seen yet out of `lines`, the last of which is chat line number `chat_seq` """
+        new_lines = min(chat_seq - self.chat_seq, len(lines))
+        if new_lines > 0:
+            self.chat_messages.extend(lines[-new_lines:])
+            del self.chat_messages[:-CHAT_HISTORY_SIZE]
+            self.chat_seq = chat_seq
+
+    def apply_binary_snapshot(self, snapshot):
+        """ Resolve the player ids of a binary snapshot to usernames, then apply it like a JSON one """
+        if snapshot['seq'] <= self.snapshot_seq:
+            return
+        if snapshot['keyframe']:
+            self.player_names.clear()
+        removed = [self.player_names.pop(player_id) for player_id in snapshot['removed'] if player_id in self.player_names]
+        changes = {}
+        for player_id, username, x, y, color in snapshot['joined']:
+            self.player_names[player_id] = username
+            changes[username] = {'x': x, 'y': y, 'color': color}
+        for player_id, x, y in snapshot['moved']:
+            if player_id in self.player_names:
+                changes[self.player_names[player_id]] = {'x': x, 'y': y}
+        snapshot.update(players=changes, removed=removed)
+        self.apply_snapshot(snapshot)
+
+    def record_positions(self, changes):
+        """
+        Buffer the positions a snapshot brought for interpolation.
+        Full records (with a color) start a fresh history so joins and players entering view
+        don't slide in from wherever they were last seen.
+        """
+        now = time.time()
+        for username, fields in changes.items():
+            player = self.players[username]
+            history = self.position_history.get(username)
+            if history is None or 'color' in fields:
+                self.position_history[username] = deque([(now, player['x'], player['y'])], maxlen=POSITION_HISTORY)
+                continue
+            last_time, last_x, last_y = history[-1]
+            if now - last_time > 1.5 * self.tick_interval:
+                # The player stood still until at most one tick ago, start the movement from there
+                history.append((now - self.tick_interval, last_x, last_y))
+            history.append((now, player['x'], player['y']))
+
+    def reconcile(self, seq, x, y):
+        """ Drop the inputs the server has applied and replay the rest on top of its position """
+        if seq < self.input_ack_seq:
+            return  # Arrived after a newer one
+        self.input_ack_seq = seq
+        while self.unacked_inputs and self.unacked_inputs[0][0] <= seq:
+            self.unacked_inputs.popleft()
+        while self.pending_inputs and self.pending_inputs[0][0] <= seq:
+            _, dx, dy = self.pending_inputs.popleft()
+            self.pending_dx -= dx
+            self.pending_dy -= dy
+        self.server_position = (x, y)
+
+    def render_players(self, view):
+        """
+        The players of a published view as they should be drawn this frame:
+        our own player at its predicted position, the others interpolated between buffered snapshots.
+        """
+        render_time = time.time() - INTERPOLATION_TICKS * self.tick_interval
+        with self.lock:  # Only held for reading the prediction, never while a message is being decoded
+            predicted = self.server_position and (self.server_position[0] + self.pending_dx, self.server_position[1] + self.pending_dy)
+        players = {}
+        for username, player in view.players.items():
+            if username == self.username and self.predict and predicted:
+                x, y = predicted
+            elif username in view.history:
+                x, y = interpolate(view.history[username], render_time)
+            else:
+                x, y = player['x'], player['y']
+            players[username] = {'x': x, 'y': y, 'color': player['color']}
+        return players
+
     def handle_render_text(self, render_text_data):
         """
         Process the render_text data from the server.
         Each item in render_text_data should be a dictionary with properties:
+        - id: (optional) element to create, patch or delete, see TextLayer
+        - op: (optional) 'create' (default), 'patch' or 'delete'
         - text: string to render
         - position: [x, y] coordinates
         - font: (optional) font name
         - size: (optional) font size
+        - spans: (optional) [[count, color], ...] runs of characters sharing a color
         - colors: (optional) list of color tuples per character
         - spacing: (optional) spacing between characters
         - duration: (optional) time in seconds to display the text
         """
-        for text_item in render_text_data:
-            element = {
-                'text': text_item.get('text', ''),
-                'position': text_item.get('position', [0, 0]),
-                'font_name': text_item.get('font', DEFAULT_FONT_NAME),
-                'font_size': text_item.get('size', DEFAULT_FONT_SIZE),
-                'colors': text_item.get('colors', []),  # List of color tuples per character
-                'spacing': text_item.get('spacing', FONT_SPACING),
-                'start_time': time.time(),
-                'duration': text_item.get('duration', 10)  # Default duration 10 seconds
-            }
-            self.render_text_elements.append(element)
+        self.text_layer.apply(render_text_data, time.time())
+
+    def send(self, message):
+        self.send_raw(encode_json(message))
+
+    def send_raw(self, data):
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def send_hot(self, data):
+        """ Send binary input or acks, as a datagram while the UDP channel is up """
+        if self.udp_active:
+            try:
+                self.udp_sock.send(self.udp_header + data)
+                return
+            except OSError:
+                pass  # Keepalives will notice if the channel is gone, this one goes over TCP
+        self.send_raw(data)
 
     def send_message(self, message):
         try:
             if message.strip():
                 # Send as a command if it starts with '/'
                 if message.startswith('/'):
-                    self.sock.sendall(json.dumps({'command': message}).encode('utf-8'))
+                    self.send({'command': message})
                 else:
-                    self.sock.sendall(json.dumps({'chat_message': message}).encode('utf-8'))
+                    self.send({'chat_message': message})
         except:
             self.running = False
             self.sock.close()
 
-    def send_input(self, horizontal, vertical):
+    def sample_input(self, horizontal, vertical):
+        """
+        Record one frame of key state.
+        Consecutive frames with the same keys make up one command, commands are sent when the keys
+        change or once per server tick, all of them in a single write.
+        When predicting, our own player moves right away.
+        """
+        with self.lock:
+            changed = (horizontal, vertical) != self.input_state
+            if changed:
+                self.end_input_command()
+                self.input_state = (horizontal, vertical)
+            if horizontal or vertical:
+                self.input_frames += 1
+                if self.predict:
+                    self.pending_dx += DIRECTION_STEP[HORIZONTAL_CODES[horizontal]] * MOVE_STEP
+                    self.pending_dy += DIRECTION_STEP[VERTICAL_CODES[vertical]] * MOVE_STEP
+            now = time.time()
+            if not changed and now - self.last_input_send < self.tick_interval:
+                return
+            self.end_input_command()
+            if self.input_commands:
+                data = b''.join(self.encode_input_command(*command) for command in self.input_commands)
+                self.input_commands = []
+            elif not (self.udp_active and self.unacked_inputs):
+                return
+            self.last_input_send = now
+            if self.udp_active:
+                # Datagrams get lost, so every input the server hasn't acknowledged yet goes out again
+                data = b''.join(frame for _, frame in self.unacked_inputs)
         try:
-            self.sock.sendall(json.dumps({'input': {'horizontal': horizontal, 'vertical': vertical}}).encode('utf-8'))
+            self.send_hot(data)
         except:
             self.running = False
             self.sock.close()
 
+    def end_input_command(self):
+        """ Close the command being sampled, idle frames are never sent (call with self.lock held) """
+        if self.input_frames:
+            horizontal, vertical = self.input_state
+            self.input_commands.append((horizontal, vertical, min(self.input_frames, MAX_INPUT_DURATION)))
+        self.input_frames = 0
+
+    def encode_input_command(self, horizontal, vertical, frames):
+        """ Number a command and keep it until the server acknowledges it (call with self.lock held) """
+        self.input_seq += 1
+        if self.predict:
+            dx = DIRECTION_STEP[HORIZONTAL_CODES[horizontal]] * MOVE_STEP * frames
+            dy = DIRECTION_STEP[VERTICAL_CODES[vertical]] * MOVE_STEP * frames
+            self.pending_inputs.append((self.input_seq, dx, dy))
+        if self.binary:
+            frame = encode_input(horizontal, vertical, self.input_seq, frames)
+            if self.udp_active:
+                self.unacked_inputs.append((self.input_seq, frame))
+            return frame
+        return encode_json({'input': {'horizontal': horizontal, 'vertical': vertical, 'seq': self.input_seq, 'duration': frames}})
+
+def interpolate(history, render_time):
+    """ Position at render_time from a (time, x, y) history, held at either end """
+    if render_time >= history[-1][0]:
+        return history[-1][1], history[-1][2]
+    for i in range(len(history) - 1, 0, -1):
+        start_time, start_x, start_y = history[i - 1]
+        if start_time <= render_time:
+            end_time, end_x, end_y = history[i]
+            t = (render_time - start_time) / (end_time - start_time) if end_time > start_time else 1
+            return round(start_x + (end_x - start_x) * t), round(start_y + (end_y - start_y) * t)
+    return history[0][1], history[0][2]
+
 def wrap_text(text, font, max_width):
     """ Helper function to wrap text for the popup """
     words = text.split(' ')
@@ -120,73 +490,251 @@ def get_font(font_name, font_size):
             FONT_CACHE[key] = pygame.font.SysFont(DEFAULT_FONT_NAME, font_size)
     return FONT_CACHE[key]
 
-def draw_popup(screen, message):
+class SurfaceCache:
+    """
+    Least-recently-used cache of rendered surfaces.
+    Font rendering is the most expensive part of a frame, so text that is drawn again and again
+    is rendered once and blitted from here, the oldest entries are dropped past max_size.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.surfaces = OrderedDict()
+
+    def get(self, font_name, font_size, text, color):
+        key = (font_name, font_size, text, tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.surfaces[key] = get_font(font_name, font_size).render(text, True, color)
+            if len(self.surfaces) > self.max_size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+GLYPH_ATLAS = SurfaceCache(GLYPH_ATLAS_SIZE)  # (font name, size, char, color) -> surface
+TEXT_CACHE = SurfaceCache(TEXT_CACHE_SIZE)  # (font name, size, string, color) -> surface
+
+def get_glyph(char, color, font_name=DEFAULT_FONT_NAME, font_size=DEFAULT_FONT_SIZE):
+    return GLYPH_ATLAS.get(font_name, font_size, char, color)
+
+def get_text_surface(text, color, font_name=DEFAULT_FONT_NAME, font_size=DEFAULT_FONT_SIZE):
+    return TEXT_CACHE.get(font_name, font_size, text, color)
+
+class Scene:
+    """
+    One frame's draw calls, recorded instead of drawn straight to the screen.
+    Every call is keyed by what it draws (a player, a chat line, a text element...),
+    which lets the dirty-rect renderer tell which parts of the frame changed since the last one.
+    """
+    def __init__(self):
+        self.ops = {}  # key -> (rect, surface or None, color, width), in draw order
+
+    def blit(self, key, surface, position):
+        self.ops[key] = (pygame.Rect(position, surface.get_size()), surface, None, 0)
+
+    def rect(self, key, color, rect, width=0):
+        self.ops[key] = (pygame.Rect(rect), None, color, width)
+
+    def draw(self, screen):
+        """ Draw the whole frame """
+        screen.fill(BLACK)
+        for op in self.ops.values():
+            draw_op(screen, op)
+
+def draw_op(screen, op):
+    rect, surface, color, width = op
+    if surface is not None:
+        screen.blit(surface, rect)
+    else:
+        pygame.draw.rect(screen, color, rect, width)
+
+class DirtyRenderer:
+    """
+    Present scenes by only redrawing what changed since the previous frame.
+    Draw calls that appeared, disappeared, moved or changed mark their old and new rects dirty,
+    each dirty rect is cleared and redrawn from the calls that overlap it, and only those rects
+    are passed to pygame.display.update(). A frame where nothing changed draws nothing at all.
+    """
+    def __init__(self, screen):
+        self.screen = screen
+        self.screen_rect = screen.get_rect()
+        self.previous = None  # Ops currently on screen, None forces a full redraw
+
+    def invalidate(self):
+        self.previous = None
+
+    def present(self, scene):
+        ops, previous = scene.ops, self.previous
+        self.previous = ops
+        if previous is None:
+            scene.draw(self.screen)
+            pygame.display.flip()
+            return
+
+        dirty = []
+        for key, op in ops.items():
+            old = previous.get(key)
+            if old is None:
+                dirty.append(op[0])
+            elif old[0] != op[0] or old[1] is not op[1] or old[2] != op[2] or old[3] != op[3]:
+                dirty.append(old[0])
+                dirty.append(op[0])
+        for key, old in previous.items():
+            if key not in ops:
+                dirty.append(old[0])
+        dirty = [rect.clip(self.screen_rect) for rect in dirty]
+        dirty = [rect for rect in dirty if rect.width and rect.height]
+        if not dirty:
+            return
+        if len(dirty) > DIRTY_RECT_LIMIT:
+            scene.draw(self.screen)
+            pygame.display.flip()
+            return
+
+        # Redraw each dirty region from the draw calls overlapping it, keeping their order
+        op_list = list(ops.values())
+        op_rects = [op[0] for op in op_list]
+        for rect in dirty:
+            self.screen.set_clip(rect)
+            self.screen.fill(BLACK)
+            for index in rect.collidelistall(op_rects):
+                draw_op(self.screen, op_list[index])
+        self.screen.set_clip(None)
+        pygame.display.update(dirty)
+
+POPUP_CACHE = {'message': None, 'lines': [], 'overlay': None}  # Last wrapped popup and the reusable overlay
+
+def draw_popup(scene, message):
     """ Draw the popup on the screen """
     popup_width, popup_height = SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2
     popup_rect = pygame.Rect(SCREEN_WIDTH // 4, SCREEN_HEIGHT // 4, popup_width, popup_height)
     max_line_width = popup_width - 40  # Padding for text inside popup
-    font = get_font(DEFAULT_FONT_NAME, DEFAULT_FONT_SIZE)
-    wrapped_message = wrap_text(message, font, max_line_width)  # Wrap the text
+    if POPUP_CACHE['message'] != message:  # Only wrap the text again when the popup changes
+        font = get_font(DEFAULT_FONT_NAME, DEFAULT_FONT_SIZE)
+        POPUP_CACHE['message'], POPUP_CACHE['lines'] = message, wrap_text(message, font, max_line_width)
 
     # Semi-transparent overlay
-    overlay = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
-    overlay.fill((0, 0, 0, 180))  # Semi-transparent black
-    screen.blit(overlay, (0, 0))
+    if POPUP_CACHE['overlay'] is None:
+        POPUP_CACHE['overlay'] = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
+        POPUP_CACHE['overlay'].fill((0, 0, 0, 180))  # Semi-transparent black
+    scene.blit(('popup_overlay',), POPUP_CACHE['overlay'], (0, 0))
 
-    pygame.draw.rect(screen, WHITE, popup_rect, 2)
+    scene.rect(('popup_border',), WHITE, popup_rect, 2)
 
     # Display the wrapped text inside the popup
     y_offset = popup_rect.y + 20
-    for line in wrapped_message:
-        text_surface = font.render(line, True, WHITE)
-        screen.blit(text_surface, (popup_rect.x + 20, y_offset))
+    for i, line in enumerate(POPUP_CACHE['lines']):
+        text_surface = get_text_surface(line, WHITE)
+        scene.blit(('popup', i), text_surface, (popup_rect.x + 20, y_offset))
         y_offset += text_surface.get_height() + 5
 
     return popup_rect  # Return the rect to detect clicks
 
-def render_custom_text(screen, client_obj):
+class TextLayer:
+    """
+    Retained render_text elements keyed by id, drawn in the order they were created.
+    Items with an id create, patch (only the fields they carry) or delete that element, so the
+    server can update a scoreboard or timer without resending it. Items without one are
+    fire-and-forget elements as before. Expiry times sit in a heap, so each frame only looks
+    at the elements that are actually due.
+    """
+    def __init__(self):
+        self.elements = {}  # id -> element dict
+        self.expiry = []  # Heap of (expiry time, counter, id), stale once the element's expiry changed
+        self.counter = 0  # Counts items, the heap's tie-breaker and the id of items that don't bring one
+
+    def apply(self, items, now):
+        for item in items:
+            element_id, op = item.get('id'), item.get('op', 'create')
+            if op not in RENDER_TEXT_OPS or not isinstance(element_id, (str, int, type(None))):
+                continue
+            self.counter += 1
+            if element_id is None:
+                element_id = ('auto', self.counter)  # Can't clash with ids that came as JSON
+            if op == 'delete':
+                self.elements.pop(element_id, None)
+                continue
+            element = self.elements.get(element_id) if op == 'patch' else None
+            expires = element['expires'] if element else None
+            if element is None:
+                element = {
+                    'text': '', 'position': [0, 0], 'font_name': DEFAULT_FONT_NAME, 'font_size': DEFAULT_FONT_SIZE,
+                    'spans': [], 'spacing': FONT_SPACING,
+                    'expires': now + 10 if item.get('id') is None else None  # Anonymous elements default to 10 seconds
+                }
+            else:
+                element = dict(element)  # Copied, the published one may be on screen right now
+            self.update(element, item)
+            self.elements[element_id] = element
+            if 'duration' in item:
+                element['expires'] = now + item['duration'] if item['duration'] else None
+            if element['expires'] is not None and element['expires'] != expires:
+                heapq.heappush(self.expiry, (element['expires'], self.counter, element_id))
+
+    def update(self, element, item):
+        """ Copy the fields `item` carries, the surface is only built again if its look changed """
+        fields = {'text': 'text', 'font': 'font_name', 'size': 'font_size', 'spans': 'spans', 'spacing': 'spacing'}
+        changed = {fields[key]: item[key] for key in fields if key in item}
+        if 'colors' in item:
+            changed['spans'] = color_spans(item['colors'])
+        if any(element.get(key) != value for key, value in changed.items()):
+            element.update(changed)
+            element.pop('surface', None)
+        if 'position' in item:
+            element['position'] = item['position']
+
+    def expire(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, _, element_id = heapq.heappop(self.expiry)
+            element = self.elements.get(element_id)
+            if element is not None and element['expires'] == expires:
+                del self.elements[element_id]
+
+def compose_text_element(element):
+    """
+    Build a render_text element's surface once from the glyph atlas,
+    so each frame costs a single blit instead of rendering every character again.
+    """
+    font_name, font_size = element['font_name'], element['font_size']
+    spacing, colors = element['spacing'], span_colors(element['spans'])
+
+    # Look up each character with its respective color
+    glyphs = []
+    for i, char in enumerate(element['text']):
+        char_color = colors[i] if i < len(colors) else WHITE  # Default to white if not specified
+        glyphs.append(get_glyph(char, char_color, font_name, font_size))
+
+    width = sum(glyph.get_width() + spacing for glyph in glyphs)
+    height = max((glyph.get_height() for glyph in glyphs), default=0)
+    surface = pygame.Surface((max(width, 1), max(height, 1)), pygame.SRCALPHA)
+    pos_x = 0
+    for glyph in glyphs:
+        surface.blit(glyph, (pos_x, 0))
+        pos_x += glyph.get_width() + spacing
+    return surface
+
+def render_custom_text(scene, view):
     """
     Render all custom text elements received from the server.
     """
-    current_time = time.time()
-    elements_to_remove = []
-    for element in client_obj.render_text_elements:
-        # Check if the text element has expired
-        if current_time - element['start_time'] > element['duration']:
-            elements_to_remove.append(element)
-            continue
-
-        text = element['text']
-        pos_x, pos_y = element['position']
-        font_name = element['font_name']
-        font_size = element['font_size']
-        spacing = element['spacing']
-        colors = element['colors']
-
-        font = get_font(font_name, font_size)
-
-        # Render each character with its respective color
-        for i, char in enumerate(text):
-            char_color = colors[i] if i < len(colors) else WHITE  # Default to white if not specified
-            char_surface = font.render(char, True, char_color)
-            screen.blit(char_surface, (pos_x, pos_y))
-            pos_x += char_surface.get_width() + spacing
-
-    # Remove expired elements
-    for element in elements_to_remove:
-        client_obj.render_text_elements.remove(element)
-
-def draw_chat(screen, chat_messages):
+    now = time.time()
+    for element_id, element in view.texts:
+        if element['expires'] is not None and element['expires'] <= now:
+            continue  # Removed from the layer on the receive thread's next wakeup
+        if 'surface' not in element:
+            element['surface'] = compose_text_element(element)
+        scene.blit(('text', element_id), element['surface'], element['position'])
+
+def draw_chat(scene, chat_messages):
     chat_rect = pygame.Rect(0, SCREEN_HEIGHT - CHAT_HEIGHT, SCREEN_WIDTH, CHAT_HEIGHT)
-    pygame.draw.rect(screen, (30, 30, 30), chat_rect)  # Removed alpha for simplicity
+    scene.rect(('chat_background',), (30, 30, 30), chat_rect)  # Removed alpha for simplicity
     y_offset = SCREEN_HEIGHT - CHAT_HEIGHT + 10
-    chat_font = get_font(DEFAULT_FONT_NAME, DEFAULT_FONT_SIZE)  # Use get_font for consistency
-    for message in chat_messages[-MAX_CHAT_MESSAGES:]:
-        chat_surface = chat_font.render(message, True, WHITE)
-        screen.blit(chat_surface, (10, y_offset))
+    for i, message in enumerate(chat_messages[-MAX_CHAT_MESSAGES:]):
+        chat_surface = get_text_surface(message, WHITE)
+        scene.blit(('chat', i), chat_surface, (10, y_offset))
         y_offset += 30
 
-def draw_speech_bubble(screen, player_x, player_y, message, hover=False, clicked=False):
+def draw_speech_bubble(scene, username, player_x, player_y, message, hover=False, clicked=False):
     if clicked:
         message_display = message[:150]  # Display up to 150 characters when clicked
     elif hover:
@@ -194,25 +742,23 @@ def draw_speech_bubble(screen, player_x, player_y, message, hover=False, clicked
     else:
         message_display = message[:15] + '...'  # Default trimmed message
 
-    speech_font = get_font(DEFAULT_FONT_NAME, DEFAULT_FONT_SIZE)  # Use get_font for consistency
-    speech_surface = speech_font.render(message_display, True, WHITE)
+    speech_surface = get_text_surface(message_display, WHITE)
     bubble_rect = speech_surface.get_rect(midbottom=(player_x, player_y - 20))
-    pygame.draw.rect(screen, BLACK, bubble_rect.inflate(10, 10))  # Bubble background
-    screen.blit(speech_surface, bubble_rect.topleft)
+    scene.rect(('bubble_background', username), BLACK, bubble_rect.inflate(10, 10))  # Bubble background
+    scene.blit(('bubble', username), speech_surface, bubble_rect.topleft)
 
-def draw_players(screen, players, client_obj):
+def draw_players(scene, players, client_obj):
     mouse_x, mouse_y = pygame.mouse.get_pos()
     for username, player_info in players.items():
-        # Retrieve the font for rendering player characters and usernames
-        player_font = get_font(DEFAULT_FONT_NAME, DEFAULT_FONT_SIZE)
-        player_surface = player_font.render('@', True, player_info['color'])
-        username_surface = player_font.render(username, True, player_info['color'])
+        # Pre-rendered surfaces for the player's character and username
+        player_surface = get_glyph('@', player_info['color'])
+        username_surface = get_text_surface(username, player_info['color'])
 
         # Draw the player's character '@'
-        screen.blit(player_surface, (player_info['x'], player_info['y']))
+        scene.blit(('player', username), player_surface, (player_info['x'], player_info['y']))
 
         # Draw the username above the character in the same color
-        screen.blit(username_surface, (player_info['x'], player_info['y'] - 20))
+        scene.blit(('name', username), username_surface, (player_info['x'], player_info['y'] - 20))
 
         # If this player is the last to send a message, show a speech bubble
         if client_obj.last_message_sender and client_obj.last_message_sender[0] == username:
@@ -225,7 +771,7 @@ def draw_players(screen, players, client_obj):
                     if player_info['x'] <= mouse_x <= player_info['x'] + 30 and player_info['y'] - 40 <= mouse_y <= player_info['y']:
                         hover = True
 
-                draw_speech_bubble(screen, player_info['x'], player_info['y'], client_obj.last_message_sender[1], hover, clicked)
+                draw_speech_bubble(scene, username, player_info['x'], player_info['y'], client_obj.last_message_sender[1], hover, clicked)
 
 def get_user_input(screen, clock, prompt_text="", default_text=''):
     input_box = pygame.Rect(SCREEN_WIDTH // 2 - 100, SCREEN_HEIGHT // 2 - 20, 200, 40)
@@ -256,11 +802,18 @@ def get_user_input(screen, clock, prompt_text="", default_text=''):
         pygame.display.flip()
         clock.tick(30)
 
-def restart_client():
-    # Restart the client script
-    os.execl(sys.executable, sys.executable, *sys.argv)
-
-def main():
+def restart_client(chat_seq, session=None):
+    # Restart the client script, passing on how far we read the chat and the session to resume
+    argv = list(sys.argv)
+    for option in ('--chat-seq', '--session'):
+        if option in argv:
+            del argv[argv.index(option):argv.index(option) + 2]
+    argv += ['--chat-seq', str(chat_seq)]
+    if session is not None:
+        argv += ['--session', str(session)]
+    os.execl(sys.executable, sys.executable, *argv)
+
+def main(dirty_rects=False, chat_seq=None, session=None):
     screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
     pygame.display.set_caption("ASCII Game with Chat")
     clock = pygame.time.Clock()
@@ -268,8 +821,9 @@ def main():
     SERVER_HOST = get_user_input(screen, clock, "Enter the server IP:", 'localhost')
     username = get_user_input(screen, clock, "Enter your name:")
 
-    client_obj = Client(username, SERVER_HOST)
+    client_obj = Client(username, SERVER_HOST, chat_seq, session)
     threading.Thread(target=client_obj.listen_for_messages, daemon=True).start()
+    renderer = DirtyRenderer(screen) if dirty_rects else None
 
     chat_input, typing_message, running = '', False, True
     while running:
@@ -277,6 +831,8 @@ def main():
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type == pygame.VIDEOEXPOSE and renderer:
+                renderer.invalidate()  # The window was uncovered, its contents can't be trusted
             elif client_obj.current_popup:
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
@@ -311,8 +867,8 @@ def main():
                 client_obj.current_popup = None
 
         keys = pygame.key.get_pressed()
+        horizontal, vertical = '', ''
         if not typing_message and not client_obj.current_popup:  # Allow movement if not in typing mode or popup
-            horizontal, vertical = '', ''
             if keys[pygame.K_LEFT] or keys[pygame.K_a]:
                 horizontal = 'left'
             elif keys[pygame.K_RIGHT] or keys[pygame.K_d]:
@@ -322,27 +878,35 @@ def main():
                 vertical = 'up'
             elif keys[pygame.K_DOWN] or keys[pygame.K_s]:
                 vertical = 'down'
+        client_obj.sample_input(horizontal, vertical)  # Sent as batched commands, not once per frame
 
-            if horizontal or vertical:  # Only send input if there's actual movement
-                client_obj.send_input(horizontal, vertical)
-
-        screen.fill(BLACK)
-        draw_players(screen, client_obj.players, client_obj)  # Draw all players
-        draw_chat(screen, client_obj.chat_messages)  # Draw chat messages
-        render_custom_text(screen, client_obj)  # Draw custom render_text elements
+        scene = Scene()
+        view = client_obj.front  # Picked up once, the receive thread swaps in a new view rather than changing this one
+        draw_players(scene, client_obj.render_players(view), client_obj)  # Draw all players
+        draw_chat(scene, view.chat)  # Draw chat messages
+        render_custom_text(scene, view)  # Draw custom render_text elements
 
         if client_obj.current_popup:
-            popup_rect = draw_popup(screen, client_obj.current_popup)
+            popup_rect = draw_popup(scene, client_obj.current_popup)
         elif typing_message:
-            chat_input_surface = FONT.render(">" + chat_input, True, RED)
-            screen.blit(chat_input_surface, (10, SCREEN_HEIGHT - 30))
+            chat_input_surface = get_text_surface(">" + chat_input, RED)
+            scene.blit(('input',), chat_input_surface, (10, SCREEN_HEIGHT - 30))
 
-        pygame.display.flip()
+        if renderer:
+            renderer.present(scene)  # Only the regions that changed
+        else:
+            scene.draw(screen)
+            pygame.display.flip()
 
     client_obj.sock.close()
     pygame.quit()
 
-    restart_client()
+    restart_client(client_obj.chat_seq, client_obj.session)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="ASCII Realms pygame client")
+    parser.add_argument('--dirty-rects', action='store_true', help="Only redraw and update the parts of the screen that changed")
+    parser.add_argument('--chat-seq', type=int, help="last chat line seen, set when the client restarts itself")
+    parser.add_argument('--session', type=int, help="session token to resume, set when the client restarts itself")
+    args = parser.parse_args()
+    main(args.dirty_rects, args.chat_seq, args.session)
@@ -0,0 +1,306 @@
+import asyncio, argparse, json, math, os, random, subprocess, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from protocol import PROTOCOL_VERSION, FEATURES, FrameDecoder, Inflater, encode_json, decode_json, is_binary
+from protocol import MSG_SNAPSHOT, MSG_INPUT_ACK, SNAPSHOT_HEADER, encode_input, encode_ack, decode_input_ack, decode_snapshot
+
+# Headless load generator: simulated players that speak the same protocol as client_pygame.Client
+# and a machine-readable report of what the server managed to deliver to them.
+
+FRAME_RATE = 60  # Frames per second a real client samples its keys at, input durations are counted in these
+SAMPLE_LIMIT = 100000  # Latency samples kept per worker process (reservoir sampled past this)
+DIRECTIONS = [('left', ''), ('right', ''), ('', 'up'), ('', 'down'), ('left', 'up'), ('right', 'down')]
+
+# Latency samples in seconds, keeping a uniform random subset once there are too many
+class Reservoir:
+    def __init__(self, limit=SAMPLE_LIMIT):
+        self.limit = limit
+        self.samples = []
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if len(self.samples) < self.limit:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.limit:
+                self.samples[index] = value
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    def pick(fraction):
+        return round(samples[min(len(samples) - 1, int(math.ceil(fraction * len(samples))) - 1)] * 1000, 3)
+    return {'count': len(samples), 'p50_ms': pick(0.5), 'p90_ms': pick(0.9), 'p99_ms': pick(0.99), 'max_ms': round(samples[-1] * 1000, 3)}
+
+# Counters shared by every bot of one worker process
+class Stats:
+    def __init__(self):
+        self.connected = self.connect_failures = self.disconnects = 0  # connected counts bots the server admitted with a welcome
+        self.not_admitted = 0  # TCP connection made, but no welcome before the bot's time was up or the server hung up
+        self.rx_messages = self.rx_bytes = self.tx_messages = self.tx_bytes = 0
+        self.rx_by_type = {}
+        self.input_rtt, self.chat_rtt = Reservoir(), Reservoir()
+
+    def count_rx(self, kind):
+        self.rx_messages += 1
+        self.rx_by_type[kind] = self.rx_by_type.get(kind, 0) + 1
+
+    def to_dict(self):
+        return {
+            'connected': self.connected, 'not_admitted': self.not_admitted, 'connect_failures': self.connect_failures, 'disconnects': self.disconnects,
+            'rx_messages': self.rx_messages, 'rx_bytes': self.rx_bytes, 'tx_messages': self.tx_messages, 'tx_bytes': self.tx_bytes,
+            'rx_by_type': self.rx_by_type, 'input_rtt': self.input_rtt.samples, 'chat_rtt': self.chat_rtt.samples
+        }
+
+# One simulated player
+class Bot:
+    def __init__(self, name, args, stats):
+        self.name, self.args, self.stats = name, args, stats
+        self.features = [feature for feature in args.features.split(',') if feature in FEATURES]
+        self.binary = self.predict = self.admitted = False
+        self.snapshot_seq = 0
+        self.chat_seq = 0
+        self.input_seq = 0
+        self.input_sent = {}  # Input seq -> send time, until the server acknowledges it
+        self.chat_sent = {}  # Chat line -> send time, until it comes back in a snapshot
+        self.decoder = FrameDecoder()
+        self.inflater = Inflater()
+        self.writer = None
+
+    def write(self, data):
+        self.writer.write(data)
+        self.stats.tx_messages += 1
+        self.stats.tx_bytes += len(data)
+
+    async def run(self):
+        try:
+            reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        except OSError:
+            self.stats.connect_failures += 1
+            return
+        deadline = time.time() + self.args.duration
+        self.write(encode_json({'hello': self.name, 'version': PROTOCOL_VERSION, 'features': self.features}))
+        tasks = [asyncio.ensure_future(self.send_loop(deadline)), asyncio.ensure_future(self.receive_loop(reader))]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(tasks)
+        if not self.admitted:
+            self.stats.not_admitted += 1  # Its inputs were never acknowledged, so they aren't in input_rtt either
+        elif tasks[1] in done or tasks[0].exception() is not None:
+            self.stats.disconnects += 1  # The server hung up before the run was over
+        self.writer.close()
+
+    # Send movement commands once per server tick and chat lines every --chat-interval seconds
+    async def send_loop(self, deadline):
+        interval = 1 / self.args.tick_rate
+        duration = max(1, round(FRAME_RATE * interval))
+        direction = random.choice(DIRECTIONS)
+        next_turn = next_chat = time.time() + random.random() * max(self.args.chat_interval, 1)
+        step = 0
+        while time.time() < deadline:
+            now = time.time()
+            if self.args.pattern == 'random' and now >= next_turn:
+                direction, next_turn = random.choice(DIRECTIONS), now + random.uniform(0.5, 2)
+            elif self.args.pattern == 'circle':
+                direction = DIRECTIONS[(step // self.args.tick_rate) % 4]
+            if self.args.pattern != 'idle':
+                self.input_seq += 1
+                if self.predict:
+                    self.input_sent[self.input_seq] = now
+                self.write(encode_input(*direction, self.input_seq, duration) if self.binary else
+                           encode_json({'input': {'horizontal': direction[0], 'vertical': direction[1], 'seq': self.input_seq, 'duration': duration}}))
+            if self.args.chat_interval and now >= next_chat:
+                line = f"{self.name} {step}"
+                self.chat_sent[f"{self.name}: {line}"] = now
+                self.write(encode_json({'chat_message': line}))
+                next_chat = now + self.args.chat_interval
+            step += 1
+            await self.writer.drain()
+            await asyncio.sleep(interval)
+
+    async def receive_loop(self, reader):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            self.stats.rx_bytes += len(data)
+            self.decoder.feed(data)
+            acked_seq = self.snapshot_seq
+            for payload in self.inflater.frames(self.decoder.frames()):
+                self.handle_frame(payload)
+            if self.snapshot_seq != acked_seq:
+                self.write(encode_ack(self.snapshot_seq) if self.binary else encode_json({'ack': self.snapshot_seq}))
+
+    def handle_frame(self, payload):
+        now = time.time()
+        if is_binary(payload) and payload[0] == MSG_INPUT_ACK:
+            self.stats.count_rx('input_ack')
+            self.input_acked(decode_input_ack(payload)[0], now)
+        elif is_binary(payload) and payload[0] == MSG_SNAPSHOT:
+            self.stats.count_rx('snapshot')
+            if self.chat_sent:
+                self.snapshot_received(decode_snapshot(payload), now)
+            else:
+                self.snapshot_seq, _, self.chat_seq = SNAPSHOT_HEADER.unpack_from(payload)[2:5]  # Nothing to look for in it
+        else:
+            message = decode_json(payload)
+            if 'welcome' in message:
+                self.stats.count_rx('welcome')
+                if not self.admitted:
+                    self.admitted = True
+                    self.stats.connected += 1
+                self.binary = 'binary' in message['welcome'].get('features', ())
+                self.predict = 'predict' in message['welcome'].get('features', ())
+                self.name = message['welcome']['username']
+            elif 'input_ack' in message:
+                self.stats.count_rx('input_ack')
+                self.input_acked(message['input_ack']['seq'], now)
+            elif 'chat_line' in message:
+                self.stats.count_rx('chat_line')
+                self.chat_received([message['chat_line']['text']], now)
+            elif 'snapshot' in message:
+                self.stats.count_rx('snapshot')
+                self.snapshot_received(message['snapshot'], now)
+            elif 'players' in message:
+                self.stats.count_rx('state')
+                self.chat_received(message['chat'], now)
+            else:
+                self.stats.count_rx(next(iter(message), 'unknown'))
+
+    def input_acked(self, seq, now):
+        for sent_seq in [sent_seq for sent_seq in self.input_sent if sent_seq <= seq]:
+            self.stats.input_rtt.add(now - self.input_sent.pop(sent_seq))
+
+    def snapshot_received(self, snapshot, now):
+        self.snapshot_seq = snapshot['seq']
+        new_lines = snapshot['chat_seq'] - self.chat_seq
+        if new_lines > 0:
+            self.chat_received(snapshot['chat'][-new_lines:], now)
+            self.chat_seq = snapshot['chat_seq']
+
+    def chat_received(self, lines, now):
+        for line in lines:
+            if line in self.chat_sent:
+                self.stats.chat_rtt.add(now - self.chat_sent.pop(line))
+
+# Worker process entry point: run its share of the bots on one event loop and return their stats
+# Bot i connects at started + i * ramp_delay whichever worker runs it
+def run_worker(args, started, indexes):
+    stats = Stats()
+
+    async def main():
+        bots = []
+        for index in indexes:
+            await asyncio.sleep(max(0, started + index * args.ramp_delay - time.time()))
+            bots.append(asyncio.ensure_future(Bot(f"bot{index}", args, stats).run()))
+        await asyncio.gather(*bots)
+
+    asyncio.run(main())
+    return stats.to_dict()
+
+# CPU seconds and resident memory of a process, read from /proc
+def process_usage(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    except (OSError, StopIteration):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), rss_kb * 1024
+
+# Sample the server's CPU and memory once a second while the workers run
+async def watch_server(pid, futures):
+    samples = []
+    while not all(future.done() for future in futures):
+        usage = process_usage(pid)
+        if usage:
+            samples.append((time.time(), *usage))
+        await asyncio.sleep(1)
+    if len(samples) < 2:
+        return None
+    elapsed = samples[-1][0] - samples[0][0]
+    return {
+        'pid': pid,
+        'cpu_percent': round(100 * (samples[-1][1] - samples[0][1]) / elapsed, 1),
+        'rss_start_bytes': samples[0][2], 'rss_peak_bytes': max(sample[2] for sample in samples), 'rss_end_bytes': samples[-1][2]
+    }
+
+def run(args):
+    server = None
+    if args.spawn_server:
+        # Keep the server's stdin open, its console exits on EOF
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+                                   '--port', str(args.port), '--tick-rate', str(args.tick_rate), *args.server_args],
+                                  stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        args.server_pid = server.pid
+        time.sleep(1)
+
+    processes = max(1, min(args.processes, args.bots))
+    started = time.time()
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(run_worker, args, started, range(worker, args.bots, processes)) for worker in range(processes)]
+        server_usage = asyncio.run(watch_server(args.server_pid, futures)) if args.server_pid else None
+        results = [future.result() for future in futures]
+    elapsed = time.time() - started
+    if server:
+        server.terminate()
+
+    totals = {key: sum(result[key] for result in results) for key in
+              ('connected', 'not_admitted', 'connect_failures', 'disconnects', 'rx_messages', 'rx_bytes', 'tx_messages', 'tx_bytes')}
+    rx_by_type = {}
+    for result in results:
+        for kind, count in result['rx_by_type'].items():
+            rx_by_type[kind] = rx_by_type.get(kind, 0) + count
+    return {
+        'started': started, 'elapsed_s': round(elapsed, 3),
+        'config': {key: value for key, value in vars(args).items() if key != 'report'},
+        'bots': args.bots, 'connected': totals['connected'], 'not_admitted': totals['not_admitted'],
+        'connect_failures': totals['connect_failures'], 'disconnects': totals['disconnects'],
+        'rx_messages_per_s': round(totals['rx_messages'] / elapsed, 1), 'rx_bytes_per_s': round(totals['rx_bytes'] / elapsed, 1),
+        'tx_messages_per_s': round(totals['tx_messages'] / elapsed, 1), 'tx_bytes_per_s': round(totals['tx_bytes'] / elapsed, 1),
+        'rx_by_type': rx_by_type, 'totals': totals,
+        'input_rtt': percentiles([sample for result in results for sample in result['input_rtt']]),
+        'chat_rtt': percentiles([sample for result in results for sample in result['chat_rtt']]),
+        'server': server_usage
+    }
+
+def print_report(report):
+    print(f"{report['connected']}/{report['bots']} bots connected, {report['not_admitted']} never admitted, "
+          f"{report['connect_failures']} failed, {report['disconnects']} disconnected in {report['elapsed_s']} s")
+    print(f"received {report['rx_messages_per_s']} msgs/s, {report['rx_bytes_per_s']} B/s; "
+          f"sent {report['tx_messages_per_s']} msgs/s, {report['tx_bytes_per_s']} B/s")
+    for name in ('input_rtt', 'chat_rtt'):
+        latency = report[name]
+        if latency['count']:
+            print(f"{name}: p50 {latency['p50_ms']} ms, p90 {latency['p90_ms']} ms, p99 {latency['p99_ms']} ms, max {latency['max_ms']} ms ({latency['count']} samples)")
+    if report['server']:
+        server = report['server']
+        print(f"server: {server['cpu_percent']}% CPU, {server['rss_peak_bytes'] // 1024} KiB peak RSS")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ASCII Realms headless load generator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=55555)
+    parser.add_argument('--bots', type=int, default=50, help="simulated players to connect")
+    parser.add_argument('--duration', type=float, default=30, help="seconds each bot stays connected once in")
+    parser.add_argument('--ramp-delay', type=float, default=0.01, help="seconds between two bot connects")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="worker processes the bots are spread over")
+    parser.add_argument('--pattern', choices=('random', 'circle', 'idle'), default='random', help="how bots move")
+    parser.add_argument('--chat-interval', type=float, default=10, help="seconds between chat lines per bot (0 disables chat)")
+    parser.add_argument('--tick-rate', type=int, default=30, help="input commands per second per bot (match the server's)")
+    parser.add_argument('--features', default=','.join(FEATURES), help="comma separated protocol features to ask for")
+    parser.add_argument('--server-pid', type=int, help="pid of the server, to report its CPU and memory")
+    parser.add_argument('--spawn-server', action='store_true', help="start server.py on --port for the run")
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[], help="extra arguments for a spawned server")
+    parser.add_argument('--report', default='loadtest_report.json', help="where to write the JSON report")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Report written to {args.report}")
@@ -0,0 +1,157 @@
+import bisect, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from 100 µs up to a second: tick, serialization and lock wait times all land in here
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Counter:
+    """ Monotonic count, optionally split by one label (e.g. message type) """
+    def __init__(self, name, help_text, label=None):
+        self.name, self.help_text, self.label = name, help_text, label
+        self.values = {}  # label value (None without a label) -> count
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values) if self.label else self.values.get(None, 0)
+
+class Gauge:
+    """ Current value read through a callback when the metrics are rendered """
+    def __init__(self, name, help_text, read):
+        self.name, self.help_text, self.read = name, help_text, read
+
+    def snapshot(self):
+        return self.read()
+
+class Histogram:
+    """ Distribution of observed values over fixed buckets, with the sum, count and max """
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name, self.help_text, self.buckets = name, help_text, buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot counts values over the largest bucket
+        self.sum = self.max = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-th quantile (the max if it is past the last bucket) """
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)
+            }
+
+class Registry:
+    """ Named metrics, rendered as a dict for /stats or as Prometheus text for scraping """
+    def __init__(self):
+        self.metrics = {}
+        self.started = time.time()
+
+    def counter(self, name, help_text, label=None):
+        return self.metrics.setdefault(name, Counter(name, help_text, label))
+
+    def gauge(self, name, help_text, read):
+        return self.metrics.setdefault(name, Gauge(name, help_text, read))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def snapshot(self):
+        stats = {'uptime_seconds': time.time() - self.started}
+        stats.update((name, metric.snapshot()) for name, metric in self.metrics.items())
+        return stats
+
+    def render_prometheus(self, prefix='ascii_realms_'):
+        lines = []
+        for name, metric in self.metrics.items():
+            name = prefix + name
+            lines.append(f"# HELP {name} {metric.help_text}")
+            if isinstance(metric, Counter):
+                lines.append(f"# TYPE {name} counter")
+                with metric.lock:
+                    values = dict(metric.values)
+                if not metric.label:
+                    lines.append(f"{name} {values.get(None, 0)}")
+                for label_value, value in values.items():
+                    if label_value is not None:
+                        lines.append(f'{name}{{{metric.label}="{label_value}"}} {value}')
+            elif isinstance(metric, Gauge):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {metric.read()}")
+            else:
+                lines.append(f"# TYPE {name} histogram")
+                with metric.lock:
+                    counts, total, count = list(metric.counts), metric.sum, metric.count
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {count}')
+                lines.append(f"{name}_sum {total}")
+                lines.append(f"{name}_count {count}")
+        return '\n'.join(lines) + '\n'
+
+class TimedLock:
+    """ threading.Lock that records how long every `with` block waited to acquire it """
+    def __init__(self, histogram):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.histogram.observe(time.perf_counter() - started)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+def serve_http(registry, port, host='127.0.0.1'):
+    """ Serve /metrics (Prometheus text) and /stats (JSON) from a daemon thread """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = registry.render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+            elif self.path == '/stats':
+                body, content_type = json.dumps(registry.snapshot(), default=str).encode('utf-8'), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Scrapes would flood the console
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,132 @@
+import sys, threading, time
+from collections import Counter
+
+DEFAULT_INTERVAL = 0.005  # Seconds between two stack samples
+
+class NullPhase:
+    """ What Profiler.phase() hands out while not profiling, so timed sections cost next to nothing """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_PHASE = NullPhase()
+
+class Phase:
+    """ One timed section, its own time excludes the phases nested inside it """
+    __slots__ = ('profiler', 'name', 'started', 'child_time')
+
+    def __init__(self, profiler, name):
+        self.profiler, self.name, self.child_time = profiler, name, 0.0
+
+    def __enter__(self):
+        self.profiler.phase_stack().append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        stack = self.profiler.phase_stack()
+        stack.pop()
+        if stack:
+            stack[-1].child_time += elapsed
+        self.profiler.record_phase(self.name, elapsed, elapsed - self.child_time)
+
+class Profiler:
+    """
+    On-demand sampling profiler for every thread of the process.
+    A background thread snapshots all thread stacks every `interval` seconds and counts them in
+    collapsed-stack form (one line per stack, the format flame graph tools read), so the threads
+    being profiled never run any profiler code. Named phases are timed explicitly on top of that.
+    """
+    def __init__(self):
+        self.running = False
+        self.stacks = Counter()  # "thread;outer frame;...;inner frame" -> samples
+        self.phases = {}  # name -> [calls, total seconds, own seconds]
+        self.samples = 0
+        self.started = self.stopped = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread = None
+
+    def start(self, interval=DEFAULT_INTERVAL):
+        """ Start a new capture, returns False if one is already running """
+        if self.running:
+            return False
+        with self.lock:
+            self.stacks, self.phases, self.samples = Counter(), {}, 0
+        self.started, self.stopped, self.interval = time.time(), None, interval
+        self.running = True
+        self.thread = threading.Thread(target=self.sample_loop, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self.running = False
+        self.thread.join()
+        self.stopped = time.time()
+        return True
+
+    def phase(self, name):
+        return Phase(self, name) if self.running else NULL_PHASE
+
+    def phase_stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def record_phase(self, name, elapsed, own):
+        with self.lock:
+            totals = self.phases.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += own
+
+    def sample_loop(self):
+        me = threading.get_ident()
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            collapsed = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                collapsed.append(';'.join(reversed(stack)))
+            frame = None  # Don't keep the last sampled frame alive while sleeping
+            with self.lock:
+                self.stacks.update(collapsed)
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def dump(self, path):
+        """ Write the collapsed stacks to `path` and return a text summary of the capture """
+        with self.lock:
+            stacks, phases, samples = Counter(self.stacks), {name: list(totals) for name, totals in self.phases.items()}, self.samples
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        elapsed = (self.stopped or time.time()) - self.started
+        lines = [f"{samples} samples over {elapsed:.1f} s written to {path}"]
+        if phases:
+            lines.append("Phase breakdown (own time excludes nested phases):")
+            for name, (calls, total, own) in sorted(phases.items(), key=lambda item: -item[1][2]):
+                lines.append(f"  {name}: {calls} calls, {total * 1000:.1f} ms total, {own * 1000:.1f} ms own "
+                             f"({100 * own / elapsed:.1f}% of wall time), {total / calls * 1e6:.0f} us/call")
+        own_samples = Counter()
+        for stack, count in stacks.items():
+            own_samples[stack.rsplit(';', 1)[-1]] += count
+        if own_samples:
+            lines.append("Top functions by samples on top of the stack (blocking calls included):")
+            for function, count in own_samples.most_common(10):
+                lines.append(f"  {count:6d} {function}")
+        return '\n'.join(lines)
@@ -0,0 +1,255 @@
+import json, struct, zlib
+
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!I')  # 4-byte big-endian payload length
+MAX_FRAME_SIZE = 1 << 20  # Refuse frames over 1 MiB instead of buffering them forever
+RECV_SIZE = 65536
+FEATURES = ('delta', 'binary', 'predict', 'udp', 'compress', 'chat_stream', 'text_scene')  # Optional features a client can ask for in its hello
+CHAT_HISTORY_SIZE = 3  # Chat lines a client shows, and state updates carry
+MOVE_STEP = 5  # Pixels moved per input frame, the server applies it and predicting clients replay it
+MAX_INPUT_DURATION = 255  # Frames a single input command can cover
+MAX_DATAGRAM_SIZE = 1200  # Bigger state goes over TCP rather than risk IP fragmentation
+COMPRESS_THRESHOLD = 128  # Frames smaller than this aren't worth compressing
+COMPRESSION_LEVEL = 6
+RENDER_TEXT_OPS = ('create', 'patch', 'delete')  # What a render_text item with an 'id' does to the element
+
+def encode_frame(payload):
+    """ Prefix a payload with its length """
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def encode_json(obj):
+    """ Serialize a message as a single JSON frame """
+    return encode_frame(json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+def decode_json(payload):
+    """ Parse a JSON frame payload (bytes or a memoryview from FrameDecoder) """
+    return json.loads(str(payload, 'utf-8'))
+
+def looks_framed(data):
+    """
+    Tell a framed hello apart from a legacy client's raw username.
+    A frame starts with its length, whose first byte is always 0 for frames under 16 MiB,
+    while a legacy username only contains printable characters.
+    """
+    return data[:1] == b'\x00'
+
+class FrameDecoder:
+    """
+    Incremental decoder for length-prefixed frames.
+    Received bytes land in one reusable bytearray and frames() yields memoryview slices of it,
+    so any number of frames can be decoded per read without copying them out first.
+    A yielded view is only valid until the next recv_into() or feed() call.
+    """
+    def __init__(self, capacity=RECV_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = self.end = 0  # Unconsumed bytes are buffer[start:end]
+        self.needed = 0  # Size of the partial frame at start, once its header is known
+        self.max_frame_size = max_frame_size
+
+    def _reserve(self, size):
+        """ Make room for at least `size` more bytes after end """
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+        size = max(size, self.needed - pending)
+        if len(self.buffer) - self.end >= size:
+            return
+        if pending + size > len(self.buffer):
+            # Grow into a new buffer rather than resizing, views handed out earlier stay intact
+            buffer = bytearray(max(len(self.buffer) * 2, pending + size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer, self.view = buffer, memoryview(buffer)
+        else:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        """ Read straight from a socket into the buffer, returns the byte count (0 on EOF) """
+        self._reserve(size)
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """ Append bytes that were already read elsewhere (e.g. from an asyncio stream) """
+        self._reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        """ Yield the payload of every complete frame in the buffer """
+        while self.end - self.start >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_frame_size:
+                raise ValueError(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+            frame_end = self.start + FRAME_HEADER.size + length
+            if frame_end > self.end:
+                self.needed = FRAME_HEADER.size + length
+                return
+            payload_start, self.start, self.needed = self.start + FRAME_HEADER.size, frame_end, 0
+            yield self.view[payload_start:frame_end]
+
+def split_frames(data, offset=0):
+    """ Yield the payload of every frame packed back to back in one datagram """
+    view = memoryview(data)
+    while offset < len(data):
+        start = offset + FRAME_HEADER.size
+        if start > len(data):
+            raise ValueError("Truncated frame header in datagram")
+        (length,) = FRAME_HEADER.unpack_from(data, offset)
+        offset = start + length
+        if offset > len(data):
+            raise ValueError("Truncated frame in datagram")
+        yield view[start:offset]
+
+# Binary hot-path messages start with a type byte below 0x20, JSON frames always start with '{'
+MSG_INPUT, MSG_ACK, MSG_SNAPSHOT, MSG_INPUT_ACK, MSG_UDP_HELLO, MSG_COMPRESSED = 1, 2, 3, 4, 5, 6
+HORIZONTAL_CODES = {'': 0, 'left': 1, 'right': 2}
+VERTICAL_CODES = {'': 0, 'up': 1, 'down': 2}
+DIRECTION_STEP = (0, -1, 1)  # Direction code -> sign of the movement along its axis
+INPUT_RECORD = struct.Struct('!BBBIB')  # type, horizontal code, vertical code, input seq, duration in frames
+ACK_RECORD = struct.Struct('!BI')  # type, snapshot seq
+INPUT_ACK_RECORD = struct.Struct('!BIii')  # type, last input seq applied, x, y after applying it
+SNAPSHOT_HEADER = struct.Struct('!BBIIIHHHB')  # type, flags, seq, base, chat_seq, joined, moved, removed, chat lines
+JOINED_RECORD = struct.Struct('!IiiBBBB')  # id, x, y, r, g, b, name length (name bytes follow)
+MOVED_RECORD = struct.Struct('!Iii')  # id, x, y
+REMOVED_RECORD = struct.Struct('!I')  # id
+CHAT_LINE_HEADER = struct.Struct('!H')  # line length (utf-8 bytes follow)
+SNAPSHOT_KEYFRAME = 0x01
+COMPRESSED_STANDALONE = 0x01  # Deflated on its own rather than as part of the connection's stream
+UDP_HEADER = struct.Struct('!Q')  # Session token from the welcome, in front of every client datagram
+UDP_HELLO = encode_frame(bytes([MSG_UDP_HELLO]))  # Probe and keepalive, echoed back by the server
+
+def is_binary(payload):
+    """ Binary messages are told apart from JSON ones by their first byte """
+    return len(payload) > 0 and payload[0] < 0x20
+
+def encode_input(horizontal, vertical, seq=0, duration=1):
+    return encode_frame(INPUT_RECORD.pack(MSG_INPUT, HORIZONTAL_CODES[horizontal], VERTICAL_CODES[vertical], seq, duration))
+
+def decode_input(payload):
+    """ Returns the (horizontal, vertical) direction codes, the seq and the duration of an input command """
+    _, horizontal, vertical, seq, duration = INPUT_RECORD.unpack_from(payload)
+    if horizontal > 2 or vertical > 2:
+        raise ValueError("Invalid direction code")
+    return horizontal, vertical, seq, duration
+
+def encode_ack(seq):
+    return encode_frame(ACK_RECORD.pack(MSG_ACK, seq))
+
+def decode_ack(payload):
+    return ACK_RECORD.unpack_from(payload)[1]
+
+def encode_input_ack(seq, x, y):
+    return encode_frame(INPUT_ACK_RECORD.pack(MSG_INPUT_ACK, seq, x, y))
+
+def decode_input_ack(payload):
+    """ Returns the (seq, x, y) of an input acknowledgement """
+    return INPUT_ACK_RECORD.unpack_from(payload)[1:]
+
+class Compressed(bytes):
+    """ Frames that are ready for the wire, a connection's writer sends them without compressing them again """
+
+def new_deflater():
+    """ Raw deflate context, one per connection keeps its history across frames """
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+
+def compress_frames(data, deflater=None):
+    """
+    Wrap one or more frames in a compressed frame.
+    Through a connection's deflater the frames are compressed against everything sent before them
+    and flushed so the client can decode them right away. Without one they are compressed standalone,
+    which any client can decode in any order, so the result can be shared between connections.
+    """
+    if deflater is None:
+        body = new_deflater()
+        body = body.compress(data) + body.flush()
+        if len(body) + 6 >= len(data):
+            return Compressed(data)  # Doesn't pay off, send as is
+        flags = COMPRESSED_STANDALONE
+    else:
+        body = deflater.compress(data) + deflater.flush(zlib.Z_SYNC_FLUSH)
+        flags = 0
+    return Compressed(encode_frame(bytes((MSG_COMPRESSED, flags)) + body))
+
+class Inflater:
+    """ Client side of 'compress': unwraps compressed frames, keeping the connection's stream context """
+    def __init__(self):
+        self.stream = zlib.decompressobj(-15)
+
+    def frames(self, payloads):
+        """ Yield every payload, with compressed frames replaced by the frames inside them """
+        for payload in payloads:
+            if is_binary(payload) and payload[0] == MSG_COMPRESSED:
+                data = payload[2:]
+                if payload[1] & COMPRESSED_STANDALONE:
+                    data = zlib.decompressobj(-15).decompress(data)
+                else:
+                    data = self.stream.decompress(data)
+                yield from split_frames(data)
+            else:
+                yield payload
+
+def encode_snapshot(seq, base, chat_seq, joined, moved, removed, chat):
+    """
+    Pack a snapshot into one binary frame.
+    - base: seq the delta is relative to, None for a keyframe
+    - joined: (id, name, x, y, color) for players the client doesn't know yet
+    - moved: (id, x, y) for players whose position changed
+    - removed: ids of players that left
+    - chat: new chat lines, chat_seq is the number of the last one
+    """
+    parts = [SNAPSHOT_HEADER.pack(MSG_SNAPSHOT, SNAPSHOT_KEYFRAME if base is None else 0, seq, base or 0, chat_seq,
+                                  len(joined), len(moved), len(removed), len(chat))]
+    for player_id, name, x, y, color in joined:
+        name = name.encode('utf-8')
+        parts.append(JOINED_RECORD.pack(player_id, x, y, *color, len(name)))
+        parts.append(name)
+    parts.extend(MOVED_RECORD.pack(*record) for record in moved)
+    parts.extend(REMOVED_RECORD.pack(player_id) for player_id in removed)
+    for line in chat:
+        line = line.encode('utf-8')
+        parts.append(CHAT_LINE_HEADER.pack(len(line)))
+        parts.append(line)
+    return encode_frame(b''.join(parts))
+
+def decode_snapshot(payload):
+    """ Unpack a binary snapshot into a dict with the same fields encode_snapshot takes """
+    _, flags, seq, base, chat_seq, n_joined, n_moved, n_removed, n_chat = SNAPSHOT_HEADER.unpack_from(payload)
+    offset = SNAPSHOT_HEADER.size
+    joined = []
+    for _ in range(n_joined):
+        player_id, x, y, r, g, b, name_length = JOINED_RECORD.unpack_from(payload, offset)
+        offset += JOINED_RECORD.size
+        joined.append((player_id, str(payload[offset:offset + name_length], 'utf-8'), x, y, (r, g, b)))
+        offset += name_length
+    moved = list(MOVED_RECORD.iter_unpack(payload[offset:offset + n_moved * MOVED_RECORD.size]))
+    offset += n_moved * MOVED_RECORD.size
+    removed = [record[0] for record in REMOVED_RECORD.iter_unpack(payload[offset:offset + n_removed * REMOVED_RECORD.size])]
+    offset += n_removed * REMOVED_RECORD.size
+    chat = []
+    for _ in range(n_chat):
+        (length,) = CHAT_LINE_HEADER.unpack_from(payload, offset)
+        offset += CHAT_LINE_HEADER.size
+        chat.append(str(payload[offset:offset + length], 'utf-8'))
+        offset += length
+    return {
+        'seq': seq, 'base': None if flags & SNAPSHOT_KEYFRAME else base, 'keyframe': bool(flags & SNAPSHOT_KEYFRAME),
+        'chat_seq': chat_seq, 'joined': joined, 'moved': moved, 'removed': removed, 'chat': chat
+    }
+
+def color_spans(colors):
+    """ Per-character colors -> [[count, [r, g, b]], ...], the run-length form render_text elements carry """
+    spans = []
+    for color in colors:
+        color = list(color)
+        if spans and spans[-1][1] == color:
+            spans[-1][0] += 1
+        else:
+            spans.append([1, color])
+    return spans
+
+def span_colors(spans):
+    """ Expand [[count, color], ...] back to one color per character """
+    return [tuple(color) for count, color in spans for _ in range(count)]
@@ -1,19 +1,75 @@
-import socket, threading, json, random, re, os
+import socket, threading, asyncio, argparse, json, random, re, os, time, math, multiprocessing, secrets, struct, traceback
+from collections import deque
+from itertools import islice
+from protocol import PROTOCOL_VERSION, FEATURES, CHAT_HISTORY_SIZE, MOVE_STEP, MAX_INPUT_DURATION, RECV_SIZE, FrameDecoder, encode_frame, encode_json, decode_json, looks_framed
+from protocol import MSG_INPUT, MSG_ACK, HORIZONTAL_CODES, VERTICAL_CODES, DIRECTION_STEP, is_binary, decode_input, decode_ack, encode_snapshot
+from protocol import encode_input_ack, MSG_UDP_HELLO, MAX_DATAGRAM_SIZE, UDP_HEADER, UDP_HELLO, split_frames
+from protocol import COMPRESS_THRESHOLD, Compressed, new_deflater, compress_frames
+from world import SpatialHash, PlayerStore
+from metrics import Registry, TimedLock, serve_http
+from profiler import Profiler, DEFAULT_INTERVAL
+from bans import BanList, parse_duration
+from chatlog import ChatLog
+from checkpoint import Checkpointer, read_checkpoint
 
-players, clients, chat_history, banned_ips = {}, [], [], []
-HOST, PORT, MAX_DIST = '0.0.0.0', 55555, 50
-lock = threading.Lock()
-BANNED_IPS_FILE = "banned_ips.json"
-
-# Load banned IPs from file
-if os.path.exists(BANNED_IPS_FILE):
-    with open(BANNED_IPS_FILE, "r") as f:
-        banned_ips = json.load(f)
-
-# Save banned IPs to file
-def save_banned_ips():
-    with open(BANNED_IPS_FILE, "w") as f:
-        json.dump(banned_ips, f)
+CHAT_BUFFER_SIZE = 256  # Recent chat lines kept for clients catching up after a reconnect
+MAX_CHAT_LINE = 200  # Characters a chat line is cut to, "name: " included (console lines have no other limit)
+players, clients, chat_history = PlayerStore(), [], deque(maxlen=CHAT_BUFFER_SIZE)
+HOST, PORT = '0.0.0.0', 55555
+TICK_RATE = 30  # Simulation ticks per second, each tick sends at most one state update per client
+INPUT_RATE = 60  # Input frames per second a client sends (its frame rate)
+MOVE_SPEED = MOVE_STEP * INPUT_RATE * 1.05  # Pixels per second a player may move along either axis, 5% over for clock drift
+MOVE_BURST = 0.25  # Seconds of unused movement a player can save up, so inputs held up by the network still apply in full
+metrics = Registry()
+tick_seconds = metrics.histogram('tick_seconds', "Time spent in a simulation tick, broadcast included")
+broadcast_seconds = metrics.histogram('broadcast_seconds', "Time spent building and queueing one broadcast")
+serialize_seconds = metrics.histogram('serialize_seconds', "Time one broadcast spent building and encoding snapshots")
+lock_wait_seconds = metrics.histogram('lock_wait_seconds', "Time spent waiting for the world lock")
+bytes_received = metrics.counter('bytes_received_total', "Bytes read from clients")
+bytes_sent = metrics.counter('bytes_sent_total', "Bytes written to clients")
+messages_received = metrics.counter('messages_received_total', "Messages received by type", 'type')
+messages_sent = metrics.counter('messages_sent_total', "Messages queued for clients by type", 'type')
+tick_errors = metrics.counter('tick_errors_total', "Ticks that raised an exception")
+MESSAGE_TYPES = ('hello', 'command', 'chat_message', 'ack', 'resync', 'input', 'udp')  # Anything else is counted as 'other'
+lock = TimedLock(lock_wait_seconds)
+profiler = Profiler()  # Started and stopped with /profile, phases below are only timed while it runs
+state_dirty = False  # Set when chat or the player list changed since the last tick
+SNAPSHOT_HISTORY = 64  # Ticks a client's acknowledged snapshot can lag behind before it gets a keyframe
+snapshot_seq, snapshots = 0, {}  # seq -> (joined, moved, removed, chat_seq) for recent snapshots
+joined_players, moved_players, removed_players = set(), set(), {}  # Changes since the last snapshot (removed maps name -> id)
+AOI_RADIUS = 1000  # Clients only receive players within this distance of their own, 0 sends everyone
+player_grid = SpatialHash(AOI_RADIUS)  # Spatial index of player positions for area-of-interest queries
+OUTBOX_HIGH_WATER = 256 * 1024  # Bytes queued for one client before it counts as a slow consumer
+SLOW_CONSUMER_TIMEOUT = 5  # Seconds a client may stay over the high-water mark before it is disconnected
+outbound_totals = {'dropped_frames': 0, 'evicted_clients': 0}  # Counters across all connections
+chat_seq = 0  # Number of chat lines ever added, the newest line in chat_history has this number
+CHAT_LOG_FILE = "chat.log"
+chat_log = None  # ChatLog writing the transcript to disk, opened when the server starts
+hud_elements = {}  # render_text element id -> (create fields with later patches applied, expiry time or None)
+CHECKPOINT_FILE = "checkpoint.bin"
+CHECKPOINT_INTERVAL = 10  # Seconds between checkpoints of resumable sessions and chat
+SESSION_TTL = 24 * 3600  # Seconds a player who left can come back to where they were
+MAX_SAVED_SESSIONS = 10000
+session_tokens = {}  # Username -> session token of a connected player
+saved_sessions = {}  # Session token -> (username, x, y, color, left at) of players who can resume, oldest first
+checkpointer, next_checkpoint = None, 0  # Checkpointer writing checkpoint.bin, started with the server
+admissions = None  # AdmissionPacer spacing out reconnects, started with the server
+waiting_hellos = deque()  # (due time, connection, hello) of reconnects the pacer held back, in the order they are due
+ZONES = 1  # Worker processes the map is split into, 1 simulates everything in this process
+ZONE_WIDTH = 2000  # Zones are vertical strips of the map this wide, the first and last one extend to infinity
+SPREAD_SPAWNS = False  # Spawn new players in the least crowded zone, off screen for the pygame client which doesn't scroll
+zone_links, zone_outbox, zone_population = [], [], []  # Front-end: pipe, queued messages and player count per zone
+player_clients, client_ids = {}, {}  # Front-end: username -> connection (its .zone simulates the player), client id -> connection
+next_client_id, shard_tick = 0, 0
+zone_index = None  # Zone worker: the zone this process simulates
+zone_clients, ghosts = {}, {}  # Zone worker: username -> ZoneClient for owned players, username -> owning zone for copies of neighbours' players
+sent_borders, zone_output = {}, []  # Zone worker: zone -> border players last shared with it, messages for the front-end
+UDP_PORT, udp_socket = None, None  # Optional datagram channel for input and state, None when disabled
+udp_sessions = {}  # Token handed out in the welcome -> connection it authenticates datagrams for
+UDP_RESEND_TIMEOUT = 0.1  # Seconds without an ack before the newest state datagram is sent again
+BANNED_IPS_FILE = "banned_ips.json"  # Ban list of older versions, imported into the log on first start
+BANS_FILE = "bans.log"  # Append-only log of bans and unbans
+bans = BanList(BANS_FILE)  # Loaded when the server starts, see bans.py
 
 # Validate username (max 15 chars, only a-z, A-Z, 0-9, _, -, +, .)
 def validate_username(name):
@@ -28,30 +84,362 @@ def resolve_duplicate_username(base_name):
         suffix += 1
     return new_name
 
+# Send one JSON message, framed if the client negotiated the framed protocol
+def send_json(client, message):
+    messages_sent.inc(1, next(iter(message)))
+    if client.framed:
+        client.sendall(encode_json(message))
+    else:
+        client.sendall(json.dumps(message).encode('utf-8'))
+
+# Collect everything that changed in any snapshot after `base` (caller holds lock)
+# Returns (joined names, moved names, removed name -> id)
+def snapshot_changes(base):
+    joined, moved, removed = set(), set(), {}
+    for seq in range(base + 1, snapshot_seq + 1):
+        if seq not in snapshots:
+            continue  # Zone workers number snapshots by tick and skip the ticks where nothing changed
+        snap_joined, snap_moved, snap_removed, _ = snapshots[seq]
+        joined |= snap_joined
+        moved |= snap_moved
+        removed.update(snap_removed)
+    return joined, moved, removed
+
+# Players a client is interested in, or None when area of interest is disabled (caller holds lock)
+def visible_players(client):
+    if not AOI_RADIUS:
+        return None
+    x, y = players.position(client.username)
+    return frozenset(player_grid.query(x, y, AOI_RADIUS))
+
+# Work out what a client acknowledged on `base` needs to reach the current state (caller holds lock)
+# Returns (names sent in full, names sent as moves, removed names, removed ids). The patch covers every
+# change after the base, so it is valid for whatever the client applied since its acknowledged snapshot.
+def snapshot_contents(base, view=None, sent_views=None):
+    if base is None:
+        return (players.keys() if view is None else view), (), (), ()
+
+    joined, moved, removed = snapshot_changes(base)
+    if view is None:
+        full = joined & players.keys()
+        moved = (moved - joined) & players.keys()
+        gone = {username for username in removed if username not in players}
+    else:
+        # Players that stayed in view in every snapshot sent since the base only need their moves,
+        # the ones that entered (or left and came back) are sent in full
+        sent = [sent_view for seq, sent_view in sent_views.items() if seq >= base]
+        full = (view - view.intersection(*sent)) | (joined & view)
+        moved = (moved & view) - full
+        gone = frozenset().union(*sent) - view
+    removed_ids = {players.ids[username] for username in gone if username in players}
+    # Ids are reused, so a departed player's id goes out even if someone else holds it now
+    # (the newcomer is sent in full and re-added right after the removal)
+    removed_ids.update(player_id for username, player_id in removed.items() if players.ids.get(username) != player_id)
+    return full, moved, gone, removed_ids
+
+# The newest `count` chat lines, oldest first (caller holds lock)
+def recent_chat(count=CHAT_HISTORY_SIZE):
+    return list(islice(chat_history, max(len(chat_history) - count, 0), None))
+
+# Chat lines a client acknowledged on `base` hasn't seen yet, as many as it shows (caller holds lock)
+def new_chat_lines(base):
+    return recent_chat(CHAT_HISTORY_SIZE if base is None else min(chat_seq - snapshots[base][3], CHAT_HISTORY_SIZE))
+
+# Encode a snapshot as JSON or with the binary codec (caller holds lock)
+# Clients with the chat stream get their chat as chat_line events, so their snapshots leave it out
+def encode_snapshot_for(base, contents, binary, with_chat=True):
+    full, moved, gone, removed_ids = contents
+    chat = new_chat_lines(base) if with_chat else []
+    if binary:
+        return encode_snapshot(
+            snapshot_seq, base, chat_seq,
+            [(players.ids[username], username, *players.position(username), players.get_color(username)) for username in full],
+            [(players.ids[username], *players.position(username)) for username in moved],
+            removed_ids, chat
+        )
+
+    changes = players.to_dict(full)
+    for username in moved:
+        x, y = players.position(username)
+        changes[username] = {'x': x, 'y': y}
+    snapshot = {'seq': snapshot_seq, 'players': changes, 'chat': chat, 'chat_seq': chat_seq}
+    if base is None:
+        snapshot['keyframe'] = True
+    else:
+        snapshot.update(base=base, removed=list(gone))
+    return encode_json({'snapshot': snapshot})
+
 # Broadcast function to send updates to all clients
 def broadcast():
-    data = json.dumps({'players': players, 'chat': chat_history}).encode('utf-8')
+    global snapshot_seq, joined_players, moved_players, removed_players
     with lock:
+        snapshot_seq += 1
+        snapshots[snapshot_seq] = (joined_players, moved_players, removed_players, chat_seq)
+        while next(iter(snapshots)) <= snapshot_seq - SNAPSHOT_HISTORY:
+            del snapshots[next(iter(snapshots))]
+        joined_players, moved_players, removed_players = set(), set(), {}
+
+        started = time.perf_counter()
+        serialize_time = 0
+        full_state = None
+        deltas = {}  # Without area of interest, encoded once per base snapshot and shared by every client acknowledged on it
+        compressed = {}  # The shared payloads above, compressed once for every client that asked for compression
         for client in clients:
-            try:
-                client.sendall(data)
-            except:
-                clients.remove(client)
-                client.close()
+            if client.closed:
+                continue  # Its handler is still cleaning up
+            serialize_started = time.perf_counter()
+            view = visible_players(client)
+            if 'delta' in client.features:
+                base = client.acked_seq if client.acked_seq in snapshots else None
+                if base == snapshot_seq:
+                    continue  # Client is already up to date
+                binary, with_chat = 'binary' in client.features, 'chat_stream' not in client.features
+                if view is None:
+                    if (base, binary, with_chat) not in deltas:
+                        deltas[base, binary, with_chat] = encode_snapshot_for(base, snapshot_contents(base), binary, with_chat)
+                    data = shared_payload(client, deltas, compressed, (base, binary, with_chat))
+                else:
+                    # Views are kept for every snapshot sent since the acknowledged one
+                    if base not in client.sent_views:
+                        base = None
+                    for seq in [seq for seq in client.sent_views if base is None or seq < base]:
+                        del client.sent_views[seq]
+                    data = encode_snapshot_for(base, snapshot_contents(base, view, client.sent_views), binary, with_chat)
+                    client.sent_views[snapshot_seq] = view
+            elif view is not None:
+                data = json.dumps({'players': players.to_dict(view), 'chat': recent_chat()}).encode('utf-8')
+                if client.framed:
+                    data = encode_frame(data)
+            else:
+                if full_state is None:
+                    legacy_data = json.dumps({'players': players.to_dict(), 'chat': recent_chat()}).encode('utf-8')
+                    full_state = {True: encode_frame(legacy_data), False: legacy_data}
+                data = shared_payload(client, full_state, compressed, client.framed)
+            if 'predict' in client.features:
+                # Tell a predicting client which of its inputs this state includes, and where they left it
+                player_id = players.ids[client.username]
+                input_seq, x, y = players.applied_input[player_id], players.x[player_id], players.y[player_id]
+                if 'binary' in client.features:
+                    prefixed = encode_input_ack(input_seq, x, y) + data
+                else:
+                    prefixed = encode_json({'input_ack': {'seq': input_seq, 'x': x, 'y': y}}) + data
+                data = Compressed(prefixed) if isinstance(data, Compressed) else prefixed  # The ack is too small to matter
+                messages_sent.inc(1, 'input_ack')
+            serialize_time += time.perf_counter() - serialize_started
+            messages_sent.inc(1, 'snapshot' if 'delta' in client.features else 'state')
+            client.send_state(data, snapshot_seq if 'delta' in client.features else None)
+            if client.is_slow_consumer():
+                # Can't keep up even with coalesced state, disconnect rather than buffer forever
+                print(f"Disconnecting slow client {client.username} ({client.backlog()} bytes queued)")
+                outbound_totals['evicted_clients'] += 1
+                client.abort()
+        serialize_seconds.observe(serialize_time)
+        broadcast_seconds.observe(time.perf_counter() - started)
+
+# A payload encoded once for many clients, compressed once too for those that asked for compression
+def shared_payload(client, payloads, compressed, key):
+    if 'compress' not in client.features or len(payloads[key]) < COMPRESS_THRESHOLD:
+        return payloads[key]
+    if key not in compressed:
+        compressed[key] = compress_frames(payloads[key])
+    return compressed[key]
+
+# Flag the world state for the next tick's broadcast (caller holds lock)
+def mark_dirty():
+    global state_dirty
+    state_dirty = True
+
+# Append a line to the shared chat history (caller holds lock)
+# Clients with the chat stream get it pushed once right away, the others with their next state update
+def add_chat(line):
+    global chat_seq
+    line = line[:MAX_CHAT_LINE]
+    chat_history.append(line)
+    chat_seq += 1
+    mark_dirty()
+    if chat_log is not None:
+        chat_log.add(chat_seq, line)
+    if zone_index is None:
+        event = None
+        for client in clients:
+            if 'chat_stream' in client.features and not client.closed:
+                if event is None:
+                    event = encode_json({'chat_line': {'seq': chat_seq, 'text': line}})
+                messages_sent.inc(1, 'chat_line')
+                client.sendall(event)
+    for zone in range(len(zone_links)):
+        zone_send(zone, ('chat', line))
+
+# Create, patch or delete render_text elements on every text_scene client, or on just `client`
+# Elements are kept here as well, so players joining later get the current HUD
+def render_text(items, client=None):
+    now = time.time()
+    with lock:
+        for item in items:
+            element_id, op = item.get('id'), item.get('op', 'create')
+            if element_id is None:
+                continue  # Shown for its duration and forgotten, nothing to keep
+            if op == 'delete':
+                hud_elements.pop(element_id, None)
+                continue
+            fields, expires = ({}, None) if op == 'create' else hud_elements.get(element_id, ({}, None))
+            fields = {**fields, **{key: value for key, value in item.items() if key not in ('op', 'duration')}}
+            if 'duration' in item:
+                expires = now + item['duration'] if item['duration'] else None
+            hud_elements[element_id] = (fields, expires)
+        for target in [client] if client else clients:
+            if 'text_scene' in target.features:
+                send_json(target, {'render_text': items})
+
+# The HUD as create items, with what is left of each element's duration (caller holds lock)
+def hud_items():
+    now = time.time()
+    for element_id, (fields, expires) in list(hud_elements.items()):
+        if expires is not None and expires <= now:
+            del hud_elements[element_id]
+    return [{**fields, 'duration': expires - now} if expires else fields for fields, expires in hud_elements.values()]
+
+# Remove a player from the world, keeping where they were in case they come back (caller holds lock)
+def drop_player(username):
+    token = session_tokens.pop(username, None)
+    if token is not None:
+        saved_sessions[token] = (username, *players.position(username), players.get_color(username), time.time())
+        if len(saved_sessions) > MAX_SAVED_SESSIONS:
+            del saved_sessions[next(iter(saved_sessions))]
+    removed_players[username] = players.remove(username)
+    player_grid.remove(username)
+    mark_dirty()
+    if username in player_clients:
+        client = player_clients.pop(username)
+        del client_ids[client.client_id]
+        zone_population[client.zone] -= 1
+        # Every zone may hold a copy of the player near its border, or be taking it over right now
+        for zone in range(ZONES):
+            zone_send(zone, ('leave', username))
+
+# Run one simulation tick: apply queued inputs, then send one state update if anything changed
+def run_tick():
+    global state_dirty
+    started = time.perf_counter()
+    if waiting_hellos:
+        admit_waiting()
+    if zone_links:
+        with profiler.phase('routing'):
+            flush_zones()  # The zone workers simulate and broadcast
+        resend_lost_states()
+        tick_seconds.observe(time.perf_counter() - started)
+        return
+    with lock, profiler.phase('movement'):
+        changed, state_dirty = state_dirty, False
+        for player_id in players.apply_moves(MOVE_STEP, MOVE_SPEED, MOVE_BURST, time.monotonic()):
+            username = players.names[player_id]
+            moved_players.add(username)
+            player_grid.move(username, players.x[player_id], players.y[player_id])
+            changed = True
+    if changed:
+        with profiler.phase('broadcast'):
+            broadcast()
+    resend_lost_states()
+    if checkpointer is not None and time.monotonic() >= next_checkpoint:
+        with profiler.phase('checkpoint'):
+            take_checkpoint()
+    tick_seconds.observe(time.perf_counter() - started)
+
+# Hand the checkpoint thread a copy of the sessions and chat, the lock is only held for a few array copies
+def take_checkpoint():
+    global next_checkpoint
+    next_checkpoint = time.monotonic() + CHECKPOINT_INTERVAL
+    with lock:
+        state = (time.time(), chat_seq, list(chat_history), players.names[:], players.x[:], players.y[:], players.color[:],
+                 dict(session_tokens), list(saved_sessions.items()))
+    checkpointer.submit(state)
+
+# Turn a state from take_checkpoint into checkpoint records (runs on the checkpoint thread)
+def checkpoint_records(state):
+    saved_at, last_chat_seq, chat, names, xs, ys, colors, tokens, saved = state
+    sessions = [(token, *session) for token, session in saved if saved_at - session[4] < SESSION_TTL]
+    for player_id, username in enumerate(names):
+        if username in tokens:
+            packed = colors[player_id]
+            sessions.append((tokens[username], username, xs[player_id], ys[player_id], (packed >> 16, (packed >> 8) & 0xFF, packed & 0xFF), 0))
+    return saved_at, last_chat_seq, sessions, chat
+
+# Warm restart: bring back the chat and the sessions players can resume from the last checkpoint
+def load_checkpoint():
+    global chat_seq
+    checkpoint = read_checkpoint(CHECKPOINT_FILE)
+    if checkpoint is None:
+        return
+    now = time.time()
+    # Players online at the time count as having left when the checkpoint was taken
+    sessions = [(token, username, x, y, color, left_at or checkpoint['saved_at']) for token, username, x, y, color, left_at in checkpoint['sessions']]
+    for token, *session in sorted(sessions, key=lambda session: session[5]):
+        if now - session[4] < SESSION_TTL:
+            saved_sessions[token] = tuple(session)
+    chat_history.extend(checkpoint['chat'])
+    chat_seq = checkpoint['chat_seq']
+    print(f"Loaded checkpoint from {time.ctime(checkpoint['saved_at'])}: {len(saved_sessions)} sessions to resume, {len(chat_history)} chat lines")
+
+# Repeat state datagrams that weren't acknowledged in time, the newest one is all a client needs to catch up
+def resend_lost_states():
+    now = time.monotonic()
+    for client in list(udp_sessions.values()):
+        state = client.udp_state
+        if state is not None and client.udp_ready and now - state[2] > UDP_RESEND_TIMEOUT:
+            client.udp_state = (state[0], state[1], now)
+            client.send_datagram(state[1])
+
+# Run one tick, an exception is logged and counted instead of ending the tick loop while sockets stay open
+def run_guarded(tick, *args):
+    try:
+        tick(*args)
+    except Exception:
+        tick_errors.inc()
+        print("Error in tick:")
+        traceback.print_exc()
+
+# Threaded mode: fixed-rate tick thread
+def tick_loop():
+    interval = 1 / TICK_RATE
+    next_tick = time.perf_counter()
+    while True:
+        run_guarded(run_tick)
+        next_tick += interval
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_tick = time.perf_counter()  # Running behind, don't try to catch up with a burst of ticks
+
+# Asyncio mode: the same tick scheduled on the event loop
+async def tick_loop_async():
+    interval = 1 / TICK_RATE
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    while True:
+        run_guarded(run_tick)
+        next_tick += interval
+        delay = next_tick - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            next_tick = loop.time()
+            await asyncio.sleep(0)  # Still yield so connections get serviced
 
 # Process slash commands
 def process_command(command, username, client):
     try:
         if command in ['/help', '/?']:
             help_text = "Commands:\n/help or /?: Show all commands\n/bye, /exit, /leave: Disconnect and restart\n/rename <new_name>: Change your username\n"
-            client.sendall(json.dumps({'command_result': help_text}).encode('utf-8'))
+            send_json(client, {'command_result': help_text})
             return True
 
         elif command in ['/bye', '/exit', '/leave']:
-            client.sendall(json.dumps({'command_result': "Goodbye!"}).encode('utf-8'))
+            send_json(client, {'command_result': "Goodbye!"})
             # Disconnect the client after sending a goodbye message
-            clients.remove(client)
-            del players[username]
+            with lock:
+                clients.remove(client)
+                drop_player(username)
             client.close()
             return True
 
@@ -61,15 +449,16 @@ def process_command(command, username, client):
                 new_name = parts[1]
                 if validate_username(new_name):
                     new_name = resolve_duplicate_username(new_name)
-                    client.sendall(json.dumps({'command_result': f"Renamed to {new_name}. Reconnect with new name."}).encode('utf-8'))
-                    clients.remove(client)
-                    del players[username]
+                    send_json(client, {'command_result': f"Renamed to {new_name}. Reconnect with new name."})
+                    with lock:
+                        clients.remove(client)
+                        drop_player(username)
                     client.close()
                 else:
-                    client.sendall(json.dumps({'command_result': "Invalid username. Max 15 chars, use a-z, A-Z, 0-9, _, -, +, ."}).encode('utf-8'))
+                    send_json(client, {'command_result': "Invalid username. Max 15 chars, use a-z, A-Z, 0-9, _, -, +, ."})
                 return True
             else:
-                client.sendall(json.dumps({'command_result': "Usage: /rename <new_name>"}).encode('utf-8'))
+                send_json(client, {'command_result': "Usage: /rename <new_name>"})
                 return True
 
         return False  # Command not processed
@@ -77,172 +466,1075 @@ def process_command(command, username, client):
         print(f"Error processing command: {e}")
         return False
 
+# Register a new player for an accepted connection, returns the final username or None
+# A client that saw chat up to `last_chat_seq` in an earlier session gets the lines it missed,
+# and one bringing the token of a saved session gets its position and color back
+def admit_client(client, username, features=(), last_chat_seq=None, session=None):
+    if not isinstance(username, str) or not validate_username(username):
+        send_json(client, {'command_result': "Invalid username. Max 15 chars, use a-z, A-Z, 0-9, _, -, +, ."})
+        client.close()
+        return None
+
+    if client.framed:
+        client.features = set(features) & set(FEATURES)  # Only what both sides understand
+        if udp_socket is None or not {'delta', 'binary', 'predict'} <= client.features:
+            # Datagrams carry binary records, and lost inputs are resent until an input_ack covers them
+            client.features.discard('udp')
+        if 'compress' in client.features:
+            client.deflater = new_deflater()
+        if 'delta' not in client.features:
+            client.features.discard('chat_stream')  # Full state updates always carry the chat
+
+    with lock:
+        username = resolve_duplicate_username(username)
+        resumed = saved_sessions.pop(session, None) if client.framed and isinstance(session, int) else None
+        if resumed is not None and time.time() - resumed[4] < SESSION_TTL:
+            _, x, y, color, _ = resumed
+            add_chat(f"Server: {username} has rejoined the game.")
+        else:
+            resumed = None
+            x, y = spawn_point()
+            color = (random.randint(180, 255), random.randint(180, 255), random.randint(180, 255))
+            add_chat(f"Server: {username} has joined the game.")
+        if client.framed and not zone_links:  # Zone workers own the positions when sharded, so nothing to save
+            session_tokens[username] = session if resumed else secrets.randbits(64)
+        players.add(username, x, y, color)
+        player_grid.insert(username, x, y)
+        joined_players.add(username)
+        client.username = username
+        clients.append(client)
+        if zone_links:
+            assign_zone(client, x, y, color)
+        mark_dirty()  # Let others know about the new player on the next tick
+
+        # Queued under the lock so no state update or chat line can overtake the welcome
+        if client.framed:
+            welcome = {'username': username, 'version': PROTOCOL_VERSION, 'features': sorted(client.features), 'tick_rate': TICK_RATE}
+            if 'udp' in client.features:
+                client.udp_token = secrets.randbits(64)
+                udp_sessions[client.udp_token] = client
+                welcome['udp'] = {'port': UDP_PORT, 'token': client.udp_token}
+            if 'chat_stream' in client.features:
+                welcome['chat_seq'] = chat_seq
+            if username in session_tokens:
+                welcome['session'] = session_tokens[username]
+            send_json(client, {'welcome': welcome})
+        if 'chat_stream' in client.features:
+            send_chat_backlog(client, last_chat_seq)
+        if 'text_scene' in client.features and hud_elements:
+            items = hud_items()
+            if items:
+                send_json(client, {'render_text': items})
+    return username
+
+# Send a chat stream client the lines after `last_seq`, or the last few if it has none (caller holds lock)
+def send_chat_backlog(client, last_seq):
+    if not isinstance(last_seq, int) or not 0 <= last_seq <= chat_seq:
+        last_seq = chat_seq - CHAT_HISTORY_SIZE  # New client, or one from before a server restart
+    missed = max(min(chat_seq - last_seq, len(chat_history)), 0)
+    lines = islice(chat_history, len(chat_history) - missed, None)
+    frames = [encode_json({'chat_line': {'seq': seq, 'text': line}}) for seq, line in enumerate(lines, chat_seq - missed + 1)]
+    if frames:
+        messages_sent.inc(len(frames), 'chat_line')
+        client.sendall(b''.join(frames))
+
+# Apply one decoded client message (command, chat or movement input)
+def handle_message(message, username, client):
+    count_message(next(iter(message), None))
+    # Check if the message contains a command
+    if 'command' in message:
+        with profiler.phase('process_command'):
+            if process_command(message['command'], username, client):
+                return  # Command processed, skip further handling
+
+    # Handle chat messages
+    elif 'chat_message' in message:
+        trimmed_message = message['chat_message'][:60]
+        with lock:
+            add_chat(f"{username}: {trimmed_message}")
+
+    # Snapshot acknowledgements pick the base for this client's next delta
+    elif 'ack' in message:
+        acknowledge(client, message['ack'])
+    elif 'resync' in message:
+        acknowledge(client, None)  # Next snapshot will be a keyframe
+
+    # The client heard back from our UDP port and wants state that way (or stopped hearing back)
+    elif 'udp' in message:
+        client.udp_ready = bool(message['udp']) and client.udp_token is not None
+
+    # Handle player movement input
+    if 'input' in message:
+        command = message['input']
+        queue_input(username, HORIZONTAL_CODES.get(command.get('horizontal'), 0), VERTICAL_CODES.get(command.get('vertical'), 0),
+                    int(command.get('seq', 0)), min(max(int(command.get('duration', 1)), 0), MAX_INPUT_DURATION))
+
+# Queue a movement command held for `duration` frames, it is applied in batch on the next tick
+def queue_input(username, horizontal, vertical, seq=0, duration=1):
+    with lock, profiler.phase('movement'):
+        if username in player_clients:
+            zone_send(player_clients[username].zone, ('input', username, horizontal, vertical, seq, duration))
+            return
+        if username in ghosts:
+            # Handed off this tick, the input follows the player to its new zone
+            zone_output.append(('relay', ghosts[username], ('input', username, horizontal, vertical, seq, duration)))
+            return
+        player_id = players.ids.get(username)  # The player may have left meanwhile
+        if player_id is not None and not (seq and seq <= players.input_seq[player_id]):  # Inputs resent over UDP apply once
+            players.queue_move(player_id, DIRECTION_STEP[horizontal] * duration, DIRECTION_STEP[vertical] * duration, seq)
+
+# Record a snapshot acknowledgement, None asks for a keyframe
+def acknowledge(client, seq):
+    state = client.udp_state
+    if state is not None and seq is not None and seq >= state[0]:
+        client.udp_state = None  # Arrived, no need to repeat it
+    if client.client_id is not None:
+        with lock:
+            if client.client_id in client_ids:
+                zone_send(client.zone, ('ack', client.username, client.client_id, seq))
+    elif seq is None:
+        client.acked_seq = None
+    else:
+        client.acked_seq = max(client.acked_seq or 0, seq)
+
+# Apply one binary hot-path message (movement input or snapshot ack)
+def handle_binary(payload, client):
+    if payload[0] == MSG_INPUT:
+        messages_received.inc(1, 'input')
+        queue_input(client.username, *decode_input(payload))
+    elif payload[0] == MSG_ACK:
+        messages_received.inc(1, 'ack')
+        acknowledge(client, decode_ack(payload))
+    else:
+        raise ValueError(f"Unknown binary message type {payload[0]}")
+
+# Decode every complete frame buffered for a framed client, the first one is the hello
+def handle_frames(client):
+    with profiler.phase('parse'):
+        for payload in client.decoder.frames():
+            if client.waiting:
+                continue  # Held back by the pacer, whatever it sends before its welcome is stale by then
+            if client.username is not None and is_binary(payload):
+                handle_binary(payload, client)
+                continue
+            message = decode_json(payload)
+            if client.username is None:
+                count_message('hello')
+                if message.get('session') is not None and hold_back(client, message):
+                    continue
+                if admit_hello(client, message) is None:
+                    return
+            else:
+                handle_message(message, client.username, client)
+
+# Admit a framed client from its hello, returns the final username or None
+def admit_hello(client, message):
+    return admit_client(client, message.get('hello'), message.get('features', ()), message.get('chat_seq'), message.get('session'))
+
+# Queue a reconnect for later if the pacer says it is over the rate, returns True if it was held back
+# Only hellos resuming a session are paced: those are the crowd that comes back at once after a restart
+def hold_back(client, message):
+    delay = admissions.delay() if admissions is not None else 0
+    if delay <= 0:
+        return False
+    client.waiting = True
+    waiting_hellos.append((time.monotonic() + delay, client, message))
+    return True
+
+# Admit the held back reconnects whose turn has come (runs on the tick)
+def admit_waiting():
+    now = time.monotonic()
+    while waiting_hellos and waiting_hellos[0][0] <= now:
+        _, client, message = waiting_hellos.popleft()
+        client.waiting = False
+        if not client.closed:
+            admit_hello(client, message)
+
+# Count a received message under its type, client-chosen keys never become new labels
+def count_message(message_type):
+    messages_received.inc(1, message_type if message_type in MESSAGE_TYPES else 'other')
+
+# Account for bytes read from a client
+def count_received(client, size):
+    client.bytes_in += size
+    bytes_received.inc(size)
+
+# Handle a chunk of bytes from a client, negotiating the protocol on the first one
+# The read loops count the bytes, so a chunk handled twice while negotiating is still counted once
+def handle_data(client, data):
+    if client.framed:
+        client.decoder.feed(data)
+        handle_frames(client)
+    elif client.username is None and looks_framed(data):
+        client.framed = True  # New clients open with a framed hello instead of a raw username
+        client.decoder.feed(data)
+        handle_frames(client)
+    elif client.username is None:
+        count_message('hello')
+        admit_client(client, data.decode('utf-8'))  # Legacy client: raw username, unframed JSON afterwards
+    else:
+        with profiler.phase('parse'):
+            handle_message(json.loads(data.decode('utf-8')), client.username, client)
+
+# Clean up after a client disconnects
+def remove_client(client):
+    username = client.username
+    with lock:
+        if username in players:
+            drop_player(username)
+            add_chat(f"Server: {username} has left the game.")
+        if client in clients:
+            clients.remove(client)
+        mark_dirty()  # Notify others about the player leaving
+
+    client.close()
+
+# Handle one datagram: a token from a welcome, then frames with binary input, acks or a hello probe
+def handle_datagram(data, address):
+    if len(data) < UDP_HEADER.size:
+        return
+    client = udp_sessions.get(UDP_HEADER.unpack_from(data)[0])
+    if client is None or client.closed:
+        return
+    count_received(client, len(data))
+    client.udp_address = address  # Follows the client if its NAT mapping changes
+    for payload in split_frames(data, UDP_HEADER.size):
+        if is_binary(payload) and payload[0] == MSG_UDP_HELLO:
+            messages_received.inc(1, 'udp_hello')
+            client.send_datagram(UDP_HELLO)
+        elif is_binary(payload):
+            handle_binary(payload, client)
+
+# Read datagrams on a thread of their own, in both server modes
+def receive_datagrams():
+    while True:
+        try:
+            data, address = udp_socket.recvfrom(RECV_SIZE)
+            handle_datagram(data, address)
+        except (OSError, ValueError, struct.error):
+            pass  # Malformed datagram, or an ICMP error reported on the socket (Windows)
+
+def start_udp(port):
+    global UDP_PORT, udp_socket
+    UDP_PORT = port
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.bind((HOST, port))
+    threading.Thread(target=receive_datagrams, daemon=True).start()
+    print(f"UDP channel for input and state on {HOST}:{port}")
+
+# Per-connection protocol state and outbound queue shared by the threaded and asyncio servers
+# Sends never block the caller: messages are queued and written by the connection's own writer.
+# State frames are coalesced, a newer one replaces an older one that hasn't been written yet.
+class Connection:
+    def __init__(self):
+        self.username = None  # Set once the player has been admitted
+        self.waiting = False  # Hello held back by the AdmissionPacer until its turn
+        self.client_id = self.zone = None  # Set when a zone worker simulates the player
+        self.framed = False  # Negotiated from the first bytes the client sends
+        self.features = set()  # Optional protocol features agreed in the hello/welcome exchange
+        self.acked_seq = None  # Last snapshot the client confirmed, None until it has a keyframe
+        self.sent_views = {}  # seq -> players that were in this client's area of interest in that snapshot
+        self.decoder = FrameDecoder()
+        self.closed = False  # No more messages are read or queued
+        self.queue_lock = threading.Lock()
+        self.outbox = deque()  # Messages that must all be delivered, in order
+        self.pending_state = None  # Newest state frame not yet handed to the writer
+        self.queued_bytes = 0  # Bytes queued or being written
+        self.dropped_frames = 0  # State frames replaced by a newer one before they were written
+        self.over_high_water_since = None
+        self.last_progress = time.monotonic()  # Last write completed, or when the queue last became non-empty
+        self.bytes_in = self.bytes_out = 0
+        self.udp_token = self.udp_address = None  # Set once a UDP session is offered, and heard from
+        self.udp_ready = False  # The client confirmed over TCP that our datagrams reach it
+        self.udp_state = None  # (seq, datagram, sent at) of the newest state sent over UDP, until acknowledged
+        self.deflater = None  # Streaming compression context, once the client asked for compression
+
+    def sendall(self, data):
+        with self.queue_lock:
+            if self.closed:
+                return
+            if not self.queued_bytes:
+                self.last_progress = time.monotonic()
+            self.outbox.append(data)
+            self.queued_bytes += len(data)
+        self._wake()
+
+    def send_state(self, data, seq=None):
+        """ Queue a state update, `seq` is the snapshot it holds (if any) so lost datagrams can be repeated """
+        if self.udp_ready and self.udp_address is not None and len(data) <= MAX_DATAGRAM_SIZE:
+            with self.queue_lock:
+                if self.closed:
+                    return
+                if self.pending_state is not None:
+                    # Superseded by this one, the client drops whichever of the two arrives later
+                    self.queued_bytes -= len(self.pending_state)
+                    self.pending_state = None
+                    self.dropped_frames += 1
+                    outbound_totals['dropped_frames'] += 1
+            if seq is not None:
+                self.udp_state = (seq, data, time.monotonic())
+            self.send_datagram(data)
+            return
+        with self.queue_lock:
+            if self.closed:
+                return
+            if self.pending_state is not None:
+                self.queued_bytes -= len(self.pending_state)
+                self.dropped_frames += 1
+                outbound_totals['dropped_frames'] += 1
+            elif not self.queued_bytes:
+                self.last_progress = time.monotonic()
+            self.pending_state = data
+            self.queued_bytes += len(data)
+        self._wake()
+
+    def next_frame(self):
+        """ Called by the writer, returns the next bytes to write or None when the queue is empty """
+        with self.queue_lock:
+            if self.outbox:
+                return self.outbox.popleft()
+            data, self.pending_state = self.pending_state, None
+            return data
+
+    def send_datagram(self, data):
+        try:
+            udp_socket.sendto(data, self.udp_address)
+        except OSError:
+            return  # Lost like any other datagram
+        self.bytes_out += len(data)
+        bytes_sent.inc(len(data))
+
+    def wire_bytes(self, data):
+        """
+        Called by the writer, in the order frames go out: compress a frame through the connection's
+        stream, so names and keys repeated from earlier frames shrink to back-references.
+        Done at write time because a coalesced state frame that is never written must not be in the stream.
+        """
+        if self.deflater is None or isinstance(data, Compressed) or len(data) < COMPRESS_THRESHOLD:
+            return data
+        return compress_frames(data, self.deflater)
+
+    def frame_written(self, data, wire_size):
+        with self.queue_lock:
+            self.queued_bytes -= len(data)
+            self.last_progress = time.monotonic()
+        self.bytes_out += wire_size
+        bytes_sent.inc(wire_size)
+
+    def queue_depth(self):
+        return len(self.outbox) + (self.pending_state is not None)
+
+    def backlog(self):
+        return self.queued_bytes
+
+    def is_slow_consumer(self):
+        """
+        True once the backlog has stayed over the high-water mark for SLOW_CONSUMER_TIMEOUT,
+        or the writer has been stuck on a write for that long (a blocking sendall hides the
+        kernel's send buffer, so a stalled threaded peer may never look big)
+        """
+        now = time.monotonic()
+        if self.queued_bytes and now - self.last_progress > SLOW_CONSUMER_TIMEOUT:
+            return True
+        if self.backlog() <= OUTBOX_HIGH_WATER:
+            self.over_high_water_since = None
+            return False
+        if self.over_high_water_since is None:
+            self.over_high_water_since = now
+        return now - self.over_high_water_since > SLOW_CONSUMER_TIMEOUT
+
+    def close(self):
+        """ Stop reading and queueing, the writer closes the socket once the queue is flushed """
+        self.closed = True
+        udp_sessions.pop(self.udp_token, None)
+        self._wake()
+
+    def abort(self):
+        """ Drop whatever is queued and close the socket right away """
+        with self.queue_lock:
+            self.closed = True
+            self.outbox.clear()
+            self.pending_state = None
+        udp_sessions.pop(self.udp_token, None)
+        self._abort()
+
+# Blocking socket connection used by the threaded server, with a writer thread per connection
+class SocketConnection(Connection):
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+        self.wakeup = threading.Event()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def _wake(self):
+        self.wakeup.set()
+
+    def write_loop(self):
+        try:
+            while True:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                data = self.next_frame()
+                while data is not None:
+                    wire = self.wire_bytes(data)
+                    self.sock.sendall(wire)
+                    self.frame_written(data, len(wire))
+                    data = self.next_frame()
+                if self.closed:
+                    break
+        except OSError:
+            pass
+        self._abort()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def close(self):
+        super().close()
+        # Don't let a stalled peer keep the writer thread around forever
+        timer = threading.Timer(SLOW_CONSUMER_TIMEOUT, self.abort)
+        timer.daemon = True
+        timer.start()
+
+    def _abort(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Also wakes the reader thread blocked in recv
+        except OSError:
+            pass
+        self.sock.close()
+
+# Spaces out reconnects to `rate` a second after a burst of `burst`, so a crowd coming back at once trickles in
+class AdmissionPacer:
+    def __init__(self, rate, burst):
+        self.interval, self.burst_window = 1 / rate, burst / rate
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        # Seconds the caller's hello has to wait for its turn
+        with self.lock:
+            now = time.monotonic()
+            self.next_slot = max(self.next_slot, now - self.burst_window) + self.interval
+            return max(self.next_slot - now, 0)
+
+# Threaded mode: one blocking loop per connection
 def handle_client(client):
     try:
         addr = client.getpeername()[0]  # Get client IP address
 
-        if addr in banned_ips:  # Check if the client's IP is banned
-            client.sendall(json.dumps({'command_result': "You are banned from this server."}).encode('utf-8'))
+        if bans.is_banned(addr):  # Check if the client's IP is banned
+            send_json(client, {'command_result': "You are banned from this server."})
             client.close()
             return
 
-        username = client.recv(1024).decode('utf-8')
-        if not validate_username(username):
-            client.sendall(json.dumps({'command_result': "Invalid username. Max 15 chars, use a-z, A-Z, 0-9, _, -, +, ."}).encode('utf-8'))
-            client.close()
-            return
+        while not client.closed:
+            try:
+                if client.framed:
+                    # Framed clients are read straight into the decoder's buffer
+                    received = client.decoder.recv_into(client.sock)
+                    if received == 0:
+                        break
+                    count_received(client, received)
+                    handle_frames(client)
+                else:
+                    data = client.recv(RECV_SIZE if client.username is None else 1024)
+                    if not data:
+                        break
+                    count_received(client, len(data))
+                    handle_data(client, data)
+            except (ConnectionResetError, ValueError):
+                break  # Client disconnected or sent invalid data
 
-        username = resolve_duplicate_username(username)
+    except Exception as e:
+        if not client.closed:
+            print(f"Error: {e}")  # Log any errors
 
-        with lock:
-            chat_history.append(f"Server: {username} has joined the game.")
-            if len(chat_history) > 3:
-                chat_history.pop(0)
-        players[username] = {
-            'x': 400, 'y': 300,
-            'color': (random.randint(180, 255), random.randint(180, 255), random.randint(180, 255))
-        }
-        last_pos = (400, 300)
+    remove_client(client)
 
-        broadcast()  # Let others know about the new player
+# Connection on an asyncio stream, its writer is a task on the event loop
+class AsyncConnection(Connection):
+    def __init__(self, reader, writer):
+        super().__init__()
+        self.reader, self.writer = reader, writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.wakeup = asyncio.Event()
+        self.loop.create_task(self.write_loop())
 
-        while True:
-            try:
-                message = json.loads(client.recv(1024).decode('utf-8'))
+    def _call(self, func, *args):
+        # asyncio objects are not thread-safe, so the console thread hands work to the loop
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
 
-                # Check if the message contains a command
-                if 'command' in message:
-                    if process_command(message['command'], username, client):
-                        continue  # Command processed, skip further handling
+    def _wake(self):
+        self._call(self.wakeup.set)
 
-                # Handle chat messages
-                elif 'chat_message' in message:
-                    trimmed_message = message['chat_message'][:60]
-                    with lock:
-                        chat_history.append(f"{username}: {trimmed_message}")
-                        if len(chat_history) > 3:
-                            chat_history.pop(0)
-
-                # Handle player movement input
-                if 'input' in message:
-                    new_x, new_y = players[username]['x'], players[username]['y']
-
-                    if message['input']['horizontal'] == 'left':
-                        new_x -= 5
-                    elif message['input']['horizontal'] == 'right':
-                        new_x += 5
-
-                    if message['input']['vertical'] == 'up':
-                        new_y -= 5
-                    elif message['input']['vertical'] == 'down':
-                        new_y += 5
-
-                    if ((new_x - last_pos[0]) ** 2 + (new_y - last_pos[1]) ** 2) ** 0.5 <= MAX_DIST:
-                        players[username]['x'], players[username]['y'] = new_x, new_y
-                        last_pos = (new_x, new_y)
-
-                broadcast()  # Send updated state to all clients
-            except (ConnectionResetError, json.JSONDecodeError):
+    async def write_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                data = self.next_frame()
+                while data is not None:
+                    wire = self.wire_bytes(data)
+                    self.writer.write(wire)
+                    self.frame_written(data, len(wire))
+                    await self.writer.drain()  # Waits while the transport buffer is over its limit
+                    data = self.next_frame()
+                if self.closed:
+                    break
+            self.writer.close()
+            await asyncio.wait_for(self.writer.wait_closed(), SLOW_CONSUMER_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            self._abort()
+
+    def backlog(self):
+        return self.queued_bytes + self.writer.transport.get_write_buffer_size()
+
+    def recv(self, size):
+        return self.reader.read(size)
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    def _abort(self):
+        self._call(self.writer.transport.abort)
+
+# Asyncio mode: every connection is a coroutine on a single event loop
+async def handle_client_async(reader, writer):
+    client = AsyncConnection(reader, writer)
+    addr = client.getpeername()
+    print(f"Connection established with {addr}")
+    if bans.is_banned(addr[0]):  # Check if IP is banned
+        send_json(client, {'command_result': "You are banned from this server."})
+        client.close()
+        return
+
+    try:
+        while not client.closed:
+            try:
+                data = await client.recv(RECV_SIZE if client.framed or client.username is None else 1024)
+                if not data:
+                    break
+                count_received(client, len(data))
+                handle_data(client, data)
+            except (ConnectionResetError, ValueError):
                 break  # Client disconnected or sent invalid data
 
     except Exception as e:
-        print(f"Error: {e}")  # Log any errors
+        if not client.closed:
+            print(f"Error: {e}")  # Log any errors
 
-    # Clean up after client disconnects
+    remove_client(client)
+
+async def serve_async():
+    server = await asyncio.start_server(handle_client_async, HOST, PORT)
+    print(f"Server started on {HOST}:{PORT} (asyncio, {TICK_RATE} Hz)")
+    asyncio.create_task(tick_loop_async())
+    async with server:
+        await server.serve_forever()
+
+# Zone of the map an x coordinate falls in
+def zone_of(x):
+    return min(max(math.floor(x / ZONE_WIDTH), 0), ZONES - 1)
+
+# Where a new player appears: the middle of the screen, or in the least crowded zone with --spread-spawns (caller holds lock)
+def spawn_point():
+    if not (zone_links and SPREAD_SPAWNS):
+        return 400, 300
+    zone = min(range(ZONES), key=zone_population.__getitem__)
+    return zone * ZONE_WIDTH + 400, 300
+
+# Front-end: queue a message for a zone worker, sent with the next tick (caller holds lock)
+def zone_send(zone, message):
+    zone_outbox[zone].append(message)
+
+# Front-end: hand a newly admitted player to the zone it spawned in (caller holds lock)
+def assign_zone(client, x, y, color):
+    global next_client_id
+    next_client_id += 1
+    client.client_id = next_client_id
+    client_ids[client.client_id] = player_clients[client.username] = client
+    client.zone = zone_of(x)
+    zone_population[client.zone] += 1
+    zone_send(client.zone, ('adopt', client.client_id, client.username, client.framed, sorted(client.features), x, y, color, 0, 0, 0.0, None))
+
+# Front-end: send every zone the messages queued since the last tick, followed by the tick itself
+def flush_zones():
+    global shard_tick, joined_players, moved_players, removed_players, state_dirty
     with lock:
-        if username in players:
-            del players[username]
-            chat_history.append(f"Server: {username} has left the game.")
-            if len(chat_history) > 3:
-                chat_history.pop(0)
-        if client in clients:
-            clients.remove(client)
+        shard_tick += 1
+        batches = []
+        for outbox in zone_outbox:
+            batches.append(outbox + [('tick', shard_tick)])
+            outbox.clear()
+        # Nothing broadcasts from here, so the change sets only need resetting
+        joined_players, moved_players, removed_players, state_dirty = set(), set(), {}, False
+    for link, batch in zip(zone_links, batches):
+        link.send(batch)
 
-    broadcast()  # Notify others about the player leaving
-    client.close()
+# Front-end: deliver what a zone worker produced in one tick (runs on a thread per zone)
+def read_zone(zone):
+    link = zone_links[zone]
+    while True:
+        try:
+            output = link.recv()
+        except (EOFError, OSError):
+            print(f"Zone {zone} worker exited, shutting down")
+            os._exit(1)
+        for message in output:
+            if message[0] == 'state':
+                client = client_ids.get(message[1])
+                if client is None or client.closed:
+                    continue  # Left since the zone built it
+                messages_sent.inc(1, 'snapshot' if 'delta' in client.features else 'state')
+                client.send_state(message[2], message[3])
+                if client.is_slow_consumer():
+                    print(f"Disconnecting slow client {client.username} ({client.backlog()} bytes queued)")
+                    outbound_totals['evicted_clients'] += 1
+                    client.abort()
+                continue
+            with lock:
+                if message[0] == 'handoff':
+                    _, client_id, username, new_zone = message[:4]
+                    client = client_ids.get(client_id)
+                    if client is None or client.username != username:
+                        continue  # Left meanwhile, every zone has already been told
+                    zone_population[client.zone] -= 1
+                    zone_population[new_zone] += 1
+                    client.zone = new_zone
+                    zone_send(new_zone, ('adopt', client_id, username, *message[4:], zone))
+                elif message[0] == 'relay':
+                    zone_send(message[1], message[2])
+
+# Zone worker: stand-in for a client connection, whatever is sent to it goes back to the front-end
+class ZoneClient:
+    closed = False
+
+    def __init__(self, client_id, username, framed, features, ack_floor):
+        self.client_id, self.username, self.framed, self.features = client_id, username, framed, set(features)
+        self.acked_seq = None  # A player arriving from another zone starts over from a keyframe
+        self.sent_views = {}
+        self.ack_floor = ack_floor  # Acks for snapshots before this one came from the previous zone
+
+    def send_state(self, data, seq=None):
+        zone_output.append(('state', self.client_id, data, seq))
+
+    def is_slow_consumer(self):
+        return False  # Judged by the front-end, which owns the socket
+
+    def abort(self):
+        pass
+
+# Zone worker: move a player to a position received from another process (caller holds lock)
+def place_player(username, x, y):
+    player_id = players.ids[username]
+    if (players.x[player_id], players.y[player_id]) != (x, y):
+        players.x[player_id], players.y[player_id] = x, y
+        player_grid.move(username, x, y)
+        moved_players.add(username)
+        mark_dirty()
+
+# Zone worker: take over simulating a player, new or crossing in from `from_zone` (caller holds lock)
+def adopt_player(client_id, username, framed, features, x, y, color, input_seq, applied_input, move_clock, from_zone):
+    if username in zone_clients:
+        return
+    if username in players:
+        ghosts.pop(username, None)  # Already shown here as a neighbour's player
+        place_player(username, x, y)
+    else:
+        players.add(username, x, y, color)
+        player_grid.insert(username, x, y)
+        joined_players.add(username)
+        mark_dirty()
+    player_id = players.ids[username]
+    players.input_seq[player_id], players.applied_input[player_id] = input_seq, applied_input
+    players.move_clock[player_id] = move_clock  # Crossing a border doesn't refill the movement allowance
+    zone_clients[username] = client = ZoneClient(client_id, username, framed, features, shard_tick + 1)
+    clients.append(client)
+    # The previous zone kept a copy of the player, make sure it hears where it went
+    sent_borders.pop(from_zone, None)
+
+# Zone worker: give a player that walked out of this zone to its new one (caller holds lock)
+def hand_off(username, zone):
+    client = zone_clients.pop(username)
+    clients.remove(client)
+    ghosts[username] = zone  # Kept as a copy until the new zone shares its borders
+    player_id = players.ids[username]
+    zone_output.append(('handoff', client.client_id, username, zone, client.framed, sorted(client.features),
+                        players.x[player_id], players.y[player_id], players.get_color(username),
+                        players.input_seq[player_id], players.applied_input[player_id], players.move_clock[player_id]))
+
+# Zone worker: tell every other zone about owned players within area-of-interest range of it (caller holds lock)
+def share_borders():
+    for zone in range(ZONES):
+        if zone == zone_index:
+            continue
+        left, right = zone * ZONE_WIDTH - AOI_RADIUS, (zone + 1) * ZONE_WIDTH + AOI_RADIUS
+        border = {}
+        for username in zone_clients:
+            player_id = players.ids[username]
+            x = players.x[player_id]
+            if not AOI_RADIUS or (zone == 0 or x >= left) and (zone == ZONES - 1 or x < right):
+                border[username] = (x, players.y[player_id], players.get_color(username))
+        if border != sent_borders.get(zone):
+            sent_borders[zone] = border
+            zone_output.append(('relay', zone, ('ghosts', zone_index, border)))
+
+# Zone worker: replace the copies of `owner`'s border players (caller holds lock)
+def update_ghosts(owner, border):
+    for username in [username for username, zone in ghosts.items() if zone == owner and username not in border]:
+        del ghosts[username]
+        drop_player(username)
+    for username, (x, y, color) in border.items():
+        if username not in players:
+            ghosts[username] = owner
+            players.add(username, x, y, color)
+            player_grid.insert(username, x, y)
+            joined_players.add(username)
+            mark_dirty()
+        elif username in ghosts:
+            ghosts[username] = owner  # May have moved on to a third zone since another one listed it
+            place_player(username, x, y)
+
+# Zone worker: apply one message routed by the front-end
+def handle_zone_message(message):
+    kind = message[0]
+    if kind == 'input':
+        queue_input(*message[1:])
+        return
+    with lock:
+        if kind == 'ack':
+            _, username, client_id, seq = message
+            client = zone_clients.get(username)
+            if client is None or client.client_id != client_id:
+                return
+            if seq is None:
+                client.acked_seq = None
+            elif seq >= client.ack_floor:
+                client.acked_seq = max(client.acked_seq or 0, seq)
+        elif kind == 'adopt':
+            adopt_player(*message[1:])
+        elif kind == 'ghosts':
+            update_ghosts(*message[1:])
+        elif kind == 'chat':
+            add_chat(message[1])
+        elif kind == 'leave':
+            username = message[1]
+            if username in zone_clients:
+                clients.remove(zone_clients.pop(username))
+            ghosts.pop(username, None)
+            if username in players:
+                drop_player(username)
+
+# Zone worker: one tick, numbered like the front-end's so snapshot seqs carry over between zones
+def run_zone_tick(tick):
+    global snapshot_seq, state_dirty, shard_tick
+    started = time.perf_counter()
+    with lock:
+        shard_tick = tick
+        changed, state_dirty = state_dirty, False
+        for player_id in players.apply_moves(MOVE_STEP, MOVE_SPEED, MOVE_BURST, time.monotonic()):
+            username = players.names[player_id]
+            x, y = players.x[player_id], players.y[player_id]
+            moved_players.add(username)
+            player_grid.move(username, x, y)
+            changed = True
+            if zone_of(x) != zone_index:
+                hand_off(username, zone_of(x))
+        if changed:
+            share_borders()
+            snapshot_seq = tick - 1
+    if changed:
+        broadcast()
+    tick_seconds.observe(time.perf_counter() - started)
+
+# Zone worker process: simulate one strip of the map, driven by ticks from the front-end
+def zone_worker(zone, config, link):
+    global zone_index, ZONES, ZONE_WIDTH, TICK_RATE, AOI_RADIUS, player_grid
+    zone_index = zone
+    ZONES, ZONE_WIDTH, TICK_RATE, AOI_RADIUS = config
+    if AOI_RADIUS:
+        player_grid = SpatialHash(AOI_RADIUS)
+    try:
+        while True:
+            for message in link.recv():
+                if message[0] == 'tick':
+                    run_guarded(run_zone_tick, message[1])
+                    link.send(zone_output[:])
+                    zone_output.clear()
+                else:
+                    handle_zone_message(message)
+    except (EOFError, KeyboardInterrupt):
+        pass  # Front-end went away
+
+# Front-end: start one worker process per zone, on separate cores
+def start_zones():
+    context = multiprocessing.get_context('spawn')
+    for zone in range(ZONES):
+        link, worker_link = context.Pipe()
+        context.Process(target=zone_worker, args=(zone, (ZONES, ZONE_WIDTH, TICK_RATE, AOI_RADIUS), worker_link),
+                        name=f"zone-{zone}", daemon=True).start()
+        zone_links.append(link)
+        zone_outbox.append([])
+        zone_population.append(0)
+    for zone in range(ZONES):
+        threading.Thread(target=read_zone, args=(zone,), daemon=True).start()
+    print(f"Map split into {ZONES} zones of width {ZONE_WIDTH}, one worker process each")
 
 # Send a message from the Console
 def send_console_message(message):
     with lock:
-        chat_history.append(f"Console: {message}")
-        if len(chat_history) > 3:
-            chat_history.pop(0)
-    broadcast()
+        add_chat(f"Console: {message}")
 
 # Kick a player by username
 def kick_player(username):
     with lock:
         if username in players:
             for client in clients:
-                if players[username]['client'] == client:
+                if client.username == username:
                     clients.remove(client)
-                    del players[username]
-                    client.sendall(json.dumps({'command_result': "You have been kicked by the console."}).encode('utf-8'))
+                    drop_player(username)
+                    send_json(client, {'command_result': "You have been kicked by the console."})
                     client.close()
-                    chat_history.append(f"Console: {username} has been kicked.")
-                    if len(chat_history) > 3:
-                        chat_history.pop(0)
-                    broadcast()
+                    add_chat(f"Console: {username} has been kicked.")
                     return True
     return False
 
-# Ban a player by IP
-def ban_player(username):
+# Ban a player by IP, for `duration` seconds or for good
+def ban_player(username, duration=None):
     with lock:
         if username in players:
             for client in clients:
-                if players[username]['client'] == client:
+                if client.username == username:
                     addr = client.getpeername()[0]
-                    banned_ips.append(addr)
-                    save_banned_ips()  # Save banned IPs to file
+                    bans.ban(addr, duration)  # Written to the log by its own thread
                     clients.remove(client)
-                    del players[username]
-                    client.sendall(json.dumps({'command_result': "You have been banned by the console."}).encode('utf-8'))
+                    drop_player(username)
+                    send_json(client, {'command_result': "You have been banned by the console."})
                     client.close()
-                    chat_history.append(f"Console: {username} and their IP {addr} have been banned.")
-                    if len(chat_history) > 3:
-                        chat_history.pop(0)
-                    broadcast()
+                    add_chat(f"Console: {username} and their IP {addr} have been banned{ban_length(duration)}.")
                     return True
     return False
 
+# Ban an address or CIDR range (IPv4 or IPv6) and disconnect everyone connected from it
+def ban_address(target, duration=None):
+    target = bans.ban(target, duration)
+    with lock:
+        for client in list(clients):
+            try:
+                addr = client.getpeername()[0]
+            except OSError:
+                continue
+            if bans.is_banned(addr):
+                clients.remove(client)
+                drop_player(client.username)
+                send_json(client, {'command_result': "You have been banned by the console."})
+                client.close()
+                add_chat(f"Console: {client.username} has been banned.")
+    print(f"Console: Banned {target}{ban_length(duration)}")
+
+def ban_length(duration):
+    return f" for {duration} seconds" if duration else ""
+
+# List the bans in effect
+def print_bans():
+    entries = bans.entries()
+    for target, expiry in sorted(entries):
+        print(f"{target}: {'permanent' if not expiry else time.strftime('until %Y-%m-%d %H:%M:%S', time.localtime(expiry))}")
+    print(f"{len(entries)} bans")
+
 # Accept connections from new clients
 def receive_connections():
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.bind((HOST, PORT))
     server.listen()
-    print(f"Server started on {HOST}:{PORT}")
+    print(f"Server started on {HOST}:{PORT} (threaded, {TICK_RATE} Hz)")
+    threading.Thread(target=tick_loop, daemon=True).start()
     
     while True:
-        client, addr = server.accept()
+        sock, addr = server.accept()
         print(f"Connection established with {addr}")
-        if addr[0] in banned_ips:  # Check if IP is banned
-            client.sendall(json.dumps({'command_result': "You are banned from this server."}).encode('utf-8'))
+        client = SocketConnection(sock)
+        if bans.is_banned(addr[0]):  # Check if IP is banned
+            send_json(client, {'command_result': "You are banned from this server."})
             client.close()
             continue
-        with lock:
-            clients.append(client)
         threading.Thread(target=handle_client, args=(client,), daemon=True).start()
 
+# Print outbound queue metrics for every client
+def print_queue_stats():
+    with lock:
+        for client in clients:
+            print(f"{client.username}: {client.queue_depth()} queued, {client.backlog()} bytes, {client.dropped_frames} dropped")
+        print(f"Total: {len(clients)} clients, {outbound_totals['dropped_frames']} state frames dropped, {outbound_totals['evicted_clients']} slow clients disconnected")
+
+# Gauges read on demand, from the console or the HTTP endpoint's thread
+metrics.gauge('players', "Players in the world", lambda: len(players))
+metrics.gauge('clients', "Admitted client connections", lambda: len(clients))
+metrics.gauge('send_queue_depth', "Messages queued across all clients", lambda: sum(client.queue_depth() for client in list(clients)))
+metrics.gauge('send_queue_max_depth', "Longest client send queue", lambda: max((client.queue_depth() for client in list(clients)), default=0))
+metrics.gauge('send_queue_bytes', "Bytes queued across all clients", lambda: sum(client.backlog() for client in list(clients)))
+last_stats = {'time': metrics.started, 'counters': {}}  # Totals at the previous /stats, for rates
+
+# Print server metrics, with rates since the previous /stats
+def print_stats():
+    now = time.time()
+    stats = metrics.snapshot()
+    elapsed = max(now - last_stats['time'], 1e-9)
+    print(f"Uptime {stats['uptime_seconds']:.0f} s, {stats['players']} players, {stats['clients']} clients, "
+          f"send queues {stats['send_queue_depth']} messages ({stats['send_queue_max_depth']} max) / {stats['send_queue_bytes']} bytes")
+    for name in ('tick_seconds', 'broadcast_seconds', 'serialize_seconds', 'lock_wait_seconds'):
+        histogram = stats[name]
+        average = histogram['sum'] / histogram['count'] if histogram['count'] else 0
+        print(f"{name}: {histogram['count']} samples, avg {average * 1000:.3f} ms, p50 <= {histogram['p50'] * 1000:g} ms, "
+              f"p99 <= {histogram['p99'] * 1000:g} ms, max {histogram['max'] * 1000:.3f} ms")
+    for name in ('bytes_received_total', 'bytes_sent_total'):
+        rate = (stats[name] - last_stats['counters'].get(name, 0)) / elapsed
+        print(f"{name}: {stats[name]} ({rate:.0f}/s)")
+    for name in ('messages_received_total', 'messages_sent_total'):
+        previous = last_stats['counters'].get(name, {})
+        rates = ', '.join(f"{kind} {count} ({(count - previous.get(kind, 0)) / elapsed:.1f}/s)" for kind, count in sorted(stats[name].items()))
+        print(f"{name}: {rates or 'none'}")
+    with lock:
+        top = sorted(clients, key=lambda client: client.bytes_out, reverse=True)[:10]
+        for client in top:
+            print(f"  {client.username}: {client.bytes_in} bytes in, {client.bytes_out} bytes out, {client.queue_depth()} queued")
+    last_stats['time'] = now
+    last_stats['counters'] = {name: stats[name] for name in ('bytes_received_total', 'bytes_sent_total', 'messages_received_total', 'messages_sent_total')}
+
+# /profile start [interval ms] | stop | dump [file]
+def profile_command(parts):
+    action = parts[1] if len(parts) > 1 else ''
+    if action == 'start':
+        try:
+            interval = float(parts[2]) / 1000 if len(parts) > 2 else DEFAULT_INTERVAL
+        except ValueError:
+            interval = 0
+        if not (interval > 0 and math.isfinite(interval)):
+            print("Usage: /profile start [interval ms], the interval must be a positive number")
+            return
+        print("Profiling started" if profiler.start(interval) else "Profiler is already running")
+    elif action == 'stop':
+        print("Profiling stopped" if profiler.stop() else "Profiler is not running")
+    elif action == 'dump':
+        if profiler.started is None:
+            print("Nothing captured yet, use /profile start")
+            return
+        path = parts[2] if len(parts) > 2 else time.strftime("profile-%Y%m%d-%H%M%S.folded")
+        try:
+            print(profiler.dump(path))
+        except OSError as e:
+            print(f"Console: {e}")
+    else:
+        print("Usage: /profile start [interval ms] | stop | dump [file]")
+
+# /text <id> <x> <y> <text> | /text move <id> <x> <y> | /text delete <id>
+def text_command(parts):
+    try:
+        if len(parts) == 3 and parts[1] == 'delete':
+            render_text([{'id': parts[2], 'op': 'delete'}])
+        elif len(parts) == 5 and parts[1] == 'move':
+            render_text([{'id': parts[2], 'op': 'patch', 'position': [int(parts[3]), int(parts[4])]}])
+        elif len(parts) == 5 and parts[1] not in ('move', 'delete'):
+            render_text([{'id': parts[1], 'position': [int(parts[2]), int(parts[3])], 'text': parts[4]}])
+        else:
+            print("Usage: /text <id> <x> <y> <text> | /text move <id> <x> <y> | /text delete <id>")
+    except ValueError:
+        print("Console: Positions must be whole numbers")
+
 # Console command input
 def console_input():
     while True:
         command = input("Console> ")
-        if command.startswith("/kick"):
+        if command.startswith("/profile"):
+            profile_command(command.split())
+        elif command == "/stats":
+            print_stats()
+        elif command == "/queues":
+            print_queue_stats()
+        elif command.startswith("/kick"):
             parts = command.split()
             if len(parts) == 2:
                 username = parts[1]
                 if not kick_player(username):
                     print(f"Console: No such player '{username}'")
+        elif command.startswith("/text"):
+            text_command(command.split(maxsplit=4))
+        elif command == "/bans":
+            print_bans()
+        elif command.startswith("/banip") or command.startswith("/unban"):
+            parts = command.split()
+            try:
+                if parts[0] == "/banip" and len(parts) in (2, 3):
+                    ban_address(parts[1], parse_duration(parts[2]) if len(parts) == 3 else None)
+                elif parts[0] == "/unban" and len(parts) == 2:
+                    print(f"Console: Unbanned {parts[1]}" if bans.unban(parts[1]) else f"Console: No ban on '{parts[1]}'")
+                else:
+                    print("Usage: /banip <address or range> [duration] | /unban <address or range>")
+            except ValueError as e:
+                print(f"Console: {e}")
         elif command.startswith("/ban"):
             parts = command.split()
-            if len(parts) == 2:
+            if len(parts) in (2, 3):
                 username = parts[1]
-                if not ban_player(username):
+                try:
+                    duration = parse_duration(parts[2]) if len(parts) == 3 else None
+                except ValueError as e:
+                    print(f"Console: {e}")
+                    continue
+                if not ban_player(username, duration):
                     print(f"Console: No such player '{username}'")
         else:
             send_console_message(command)
 
 if __name__ == "__main__":
-    threading.Thread(target=receive_connections, daemon=True).start()
+    parser = argparse.ArgumentParser(description="ASCII Realms server")
+    parser.add_argument('--threaded', action='store_true', help="use one thread per connection instead of the asyncio event loop")
+    parser.add_argument('--port', type=int, default=PORT, help="TCP port to listen on")
+    parser.add_argument('--tick-rate', type=int, default=TICK_RATE, help="simulation ticks per second (e.g. 20, 30, 60)")
+    parser.add_argument('--metrics-port', type=int, default=0, help="serve /metrics (Prometheus text) and /stats (JSON) on this localhost port (0 disables)")
+    parser.add_argument('--aoi-radius', type=int, default=AOI_RADIUS, help="only send players within this distance of each client's player (0 sends everyone)")
+    parser.add_argument('--udp-port', type=int, default=None, help="UDP port for the optional input and state channel (default: the TCP port, 0 disables)")
+    parser.add_argument('--chat-log-size', type=int, default=1024, help="KiB chat.log may grow to before it is rotated (0 disables the chat log)")
+    parser.add_argument('--chat-log-backups', type=int, default=5, help="rotated chat logs to keep (chat.log.1, chat.log.2, ...)")
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL, help="seconds between checkpoints of sessions and chat to checkpoint.bin (0 disables them)")
+    parser.add_argument('--admit-rate', type=float, default=20, help="reconnects resuming a session admitted per second once a burst of as many has come in (0 admits all at once)")
+    parser.add_argument('--zones', type=int, default=ZONES, help="split the map into this many zones, each simulated by its own process (0 uses one per CPU core)")
+    parser.add_argument('--zone-width', type=int, default=ZONE_WIDTH, help="width of each zone's strip of the map")
+    parser.add_argument('--spread-spawns', action='store_true', help="spawn new players in the least crowded zone (the pygame client only shows the first one)")
+    args = parser.parse_args()
+    bans.open(BANNED_IPS_FILE)
+    chat_log = ChatLog(CHAT_LOG_FILE, args.chat_log_size * 1024, args.chat_log_backups) if args.chat_log_size else None
+    PORT = args.port
+    TICK_RATE = max(1, args.tick_rate)
+    AOI_RADIUS = max(0, args.aoi_radius)
+    if AOI_RADIUS:
+        player_grid = SpatialHash(AOI_RADIUS)
+    ZONES = args.zones if args.zones > 0 else os.cpu_count() or 1
+    ZONE_WIDTH = max(800, args.zone_width)  # A new player spawns 400 px into its zone
+    SPREAD_SPAWNS = args.spread_spawns
+    if args.udp_port != 0:
+        start_udp(PORT if args.udp_port is None else args.udp_port)
+    if ZONES > 1:
+        start_zones()
+    elif args.checkpoint_interval > 0:
+        load_checkpoint()
+        CHECKPOINT_INTERVAL = args.checkpoint_interval
+        checkpointer = Checkpointer(CHECKPOINT_FILE, checkpoint_records)
+    if args.admit_rate > 0:
+        admissions = AdmissionPacer(args.admit_rate, max(1, round(args.admit_rate)))
+    if args.metrics_port:
+        serve_http(metrics, args.metrics_port)
+        print(f"Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+
+    if args.threaded:
+        threading.Thread(target=receive_connections, daemon=True).start()
+    else:
+        threading.Thread(target=asyncio.run, args=(serve_async(),), daemon=True).start()
     console_input()  # Start console input thread
@@ -0,0 +1,218 @@
+import math
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Optional, without it the tick's movement pass goes one player at a time
+
+COORD_MIN, COORD_MAX = -(2 ** 31), 2 ** 31 - 1  # Positions are stored (and sent) as 32-bit ints
+
+class SpatialHash:
+    """
+    Uniform grid index over player positions.
+    Each cell holds the keys inside it, so a radius query only looks at the cells the
+    circle overlaps instead of every player in the world.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}  # (cell_x, cell_y) -> set of keys
+        self.positions = {}  # key -> (x, y, cell)
+
+    def _cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def insert(self, key, x, y):
+        cell = self._cell(x, y)
+        self.cells.setdefault(cell, set()).add(key)
+        self.positions[key] = (x, y, cell)
+
+    def move(self, key, x, y):
+        """ Update a key's position, only touching the cell sets when it crosses into a new cell """
+        cell = self._cell(x, y)
+        old_cell = self.positions[key][2]
+        if cell != old_cell:
+            self._discard(key, old_cell)
+            self.cells.setdefault(cell, set()).add(key)
+        self.positions[key] = (x, y, cell)
+
+    def remove(self, key):
+        self._discard(key, self.positions.pop(key)[2])
+
+    def _discard(self, key, cell):
+        members = self.cells[cell]
+        members.discard(key)
+        if not members:
+            del self.cells[cell]
+
+    def query(self, x, y, radius):
+        """ Return the set of keys within `radius` of (x, y) """
+        min_x, min_y = self._cell(x - radius, y - radius)
+        max_x, max_y = self._cell(x + radius, y + radius)
+        radius_sq = radius * radius
+        found = set()
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                for key in self.cells.get((cell_x, cell_y), ()):
+                    key_x, key_y, _ = self.positions[key]
+                    if (key_x - x) ** 2 + (key_y - y) ** 2 <= radius_sq:
+                        found.add(key)
+        return found
+
+class PlayerStore:
+    """
+    Struct-of-arrays player storage.
+    Positions, colors and queued movement live in flat columns indexed by a small integer
+    player id, with a name <-> id index on the side. Ids of players that left are reused.
+    With NumPy the columns are typed arrays and the tick's movement pass runs as whole-column
+    operations on NumPy views of them. Without it positions and queued movement are plain
+    lists, which a loop over single players indexes fastest.
+    """
+    def __init__(self, vectorized=None):
+        self.vectorized = numpy is not None if vectorized is None else vectorized  # False forces the scalar pass
+        self.x, self.y = self._column('i'), self._column('i')
+        self.color = array('I')  # 0xRRGGBB
+        self.move_x, self.move_y = self._column('i'), self._column('i')  # Direction steps queued since the last tick
+        self.move_clock = self._column('d')  # Time up to which the player has used its movement allowance
+        self.input_seq = array('I')  # Seq of the newest input queued
+        self.applied_input = array('I')  # Seq of the newest input applied by a tick
+        self.names = []  # id -> username, None for a free slot
+        self.ids = {}  # username -> id
+        self.free_ids = []
+        self.queued = set()  # ids with queued movement
+
+    def _column(self, typecode):
+        return array(typecode) if self.vectorized else []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, username):
+        return username in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def keys(self):
+        return self.ids.keys()
+
+    def add(self, username, x, y, color):
+        if self.free_ids:
+            player_id = self.free_ids.pop()
+            self.x[player_id], self.y[player_id] = x, y
+            self.color[player_id] = (color[0] << 16) | (color[1] << 8) | color[2]
+            self.input_seq[player_id] = self.applied_input[player_id] = 0
+            self.move_clock[player_id] = 0.0
+            self.names[player_id] = username
+        else:
+            player_id = len(self.names)
+            self.x.append(x)
+            self.y.append(y)
+            self.color.append((color[0] << 16) | (color[1] << 8) | color[2])
+            self.move_x.append(0)
+            self.move_y.append(0)
+            self.move_clock.append(0.0)
+            self.input_seq.append(0)
+            self.applied_input.append(0)
+            self.names.append(username)
+        self.ids[username] = player_id
+        return player_id
+
+    def remove(self, username):
+        player_id = self.ids.pop(username)
+        self.names[player_id] = None
+        self.move_x[player_id] = self.move_y[player_id] = 0
+        self.queued.discard(player_id)
+        self.free_ids.append(player_id)
+        return player_id
+
+    def position(self, username):
+        player_id = self.ids[username]
+        return self.x[player_id], self.y[player_id]
+
+    def get_color(self, username):
+        packed = self.color[self.ids[username]]
+        return (packed >> 16, (packed >> 8) & 0xFF, packed & 0xFF)
+
+    def record(self, username):
+        """ The player as the {'x', 'y', 'color'} dict JSON clients expect """
+        x, y = self.position(username)
+        return {'x': x, 'y': y, 'color': self.get_color(username)}
+
+    def to_dict(self, usernames=None):
+        return {username: self.record(username) for username in (self.ids if usernames is None else usernames)}
+
+    def queue_move(self, player_id, step_x, step_y, seq=0):
+        self.move_x[player_id] += step_x
+        self.move_y[player_id] += step_y
+        if seq:
+            self.input_seq[player_id] = seq
+        self.queued.add(player_id)
+
+    def apply_moves(self, step, speed, burst, now):
+        """
+        Apply every queued move in one pass over the columns, returns the ids that moved.
+        A player may move `speed` pixels per second along either axis (anti-teleport), and can
+        save up `burst` seconds of it so inputs delayed by the network still apply in full once
+        they arrive. Moves are scaled back to what the player has left, measured against `now`
+        (time.monotonic()), and kept inside the 32-bit coordinate range. Queued input seqs become
+        the applied ones.
+        """
+        if self.vectorized:
+            return self._apply_moves_vectorized(step, speed, burst, now)
+        xs, ys, move_x, move_y, move_clock = self.x, self.y, self.move_x, self.move_y, self.move_clock
+        input_seq, applied_input = self.input_seq, self.applied_input
+        saved_since = now - burst
+        moved = []
+        for player_id in self.queued:
+            applied_input[player_id] = input_seq[player_id]
+            dx, dy = move_x[player_id] * step, move_y[player_id] * step
+            move_x[player_id] = move_y[player_id] = 0
+            if not dx and not dy:
+                continue
+            start = max(move_clock[player_id], saved_since)
+            allowed, dist = (now - start) * speed, max(abs(dx), abs(dy))
+            if dist > allowed:
+                scale = allowed / dist
+                dx, dy = int(dx * scale), int(dy * scale)
+                if not dx and not dy:
+                    continue
+                dist = max(abs(dx), abs(dy))
+            move_clock[player_id] = start + dist / speed
+            x, y = xs[player_id] + dx, ys[player_id] + dy
+            if not COORD_MIN <= x <= COORD_MAX:
+                x = min(max(x, COORD_MIN), COORD_MAX)
+            if not COORD_MIN <= y <= COORD_MAX:
+                y = min(max(y, COORD_MIN), COORD_MAX)
+            xs[player_id], ys[player_id] = x, y
+            moved.append(player_id)
+        self.queued = set()
+        return moved
+
+    def _apply_moves_vectorized(self, step, speed, burst, now):
+        """ apply_moves as NumPy operations on views of the arrays, the columns themselves are never copied """
+        if not self.queued:
+            return []
+        ids = numpy.fromiter(self.queued, numpy.intp, len(self.queued))
+        self.queued = set()
+        xs, ys = numpy.frombuffer(self.x, numpy.intc), numpy.frombuffer(self.y, numpy.intc)
+        move_x, move_y = numpy.frombuffer(self.move_x, numpy.intc), numpy.frombuffer(self.move_y, numpy.intc)
+        move_clock = numpy.frombuffer(self.move_clock, numpy.float64)
+        numpy.frombuffer(self.applied_input, numpy.uintc)[ids] = numpy.frombuffer(self.input_seq, numpy.uintc)[ids]
+        dx, dy = move_x[ids].astype(numpy.int64) * step, move_y[ids].astype(numpy.int64) * step
+        move_x[ids] = move_y[ids] = 0
+        moving = (dx != 0) | (dy != 0)
+        ids, dx, dy = ids[moving], dx[moving], dy[moving]
+        start = numpy.maximum(move_clock[ids], now - burst)
+        allowed, dist = (now - start) * speed, numpy.maximum(numpy.abs(dx), numpy.abs(dy))
+        over = dist > allowed
+        if over.any():
+            scale = allowed[over] / dist[over]
+            dx[over] = dx[over] * scale  # Truncated toward zero like int()
+            dy[over] = dy[over] * scale
+            moving = (dx != 0) | (dy != 0)
+            ids, dx, dy, start = ids[moving], dx[moving], dy[moving], start[moving]
+            dist = numpy.maximum(numpy.abs(dx), numpy.abs(dy))
+        move_clock[ids] = start + dist / speed
+        xs[ids] = numpy.clip(xs[ids] + dx, COORD_MIN, COORD_MAX)
+        ys[ids] = numpy.clip(ys[ids] + dy, COORD_MIN, COORD_MAX)
+        return ids.tolist()